@@ -6,6 +6,7 @@
 SAMPLERATE = 48000
 
 # Path to the directory containing your FFmpeg and FFprobe executables
+# (if they aren't there, Chorus looks wherever the system looks for programs)
 FFMPEG = r"c:/Program Files/ffmpeg/bin/"
 
 # How many audio channels will the final mix contain?
@@ -20,6 +21,17 @@ LONGEST = 19
 # How long is the fade between volume levels (including mute)?
 FADE = 0.5
 
+# Where are the speakers of each layout that sounds can be moved around (see
+# makeSpatialNodes)? Each layout is a list of azimuths in degrees, clockwise from
+# straight ahead, one for each channel in order. These are rings of 8, 16 and 32
+# equally spaced speakers, the first straight ahead; add your own to suit the room.
+SPEAKERLAYOUTS = {speakers: [360 * i / speakers for i in range(speakers)] for speakers in (8, 16, 32)}
+
+# When sounds are moved around the speakers, how many samples apart are the points
+# at which the gain of every speaker is worked out? Gains move in straight lines
+# between them.
+PANSTEP = 64
+
 # Which file extensions (case-insentitive) do we consider to be audio files?
 EXTS = [".m4a", ".mp4", ".wav", ".aiff", ".aif", ".mp3", ".mp2", ".webm", ".ogg", ".vorbis", ".opus", ".flac"]
 
@@ -43,76 +55,810 @@ COMPRESSEDCODEC = " -vn -acodec pcm_s16le "
 # Which codec is to be used for the final output files?
 OUTPUTCODEC = " -vn -acodec libopus -vbr on -b:a 44k "
 
-# Where shall the temporary files for FFmpeg commands be stored?
-# Put them somewhere visible if you wish to debug them.
+# Which filters are applied to every finished mix?
+MIXPOST = "volume=-20dB,bass=f=400:g=-5,treble=f=200:g=15,treble=f=1800:g=10,dynaudnorm,bs2b"
+
+# How many inputs will FFmpeg's 'amix' filter accept? (1024 with the patch supplied, 32 without.)
+# Larger mixes are summed by Chorus itself instead.
+AMIXLIMIT = 1024
+
+# How many samples at a time does Chorus add together when it mixes files itself?
+MIXBLOCK = 65536
+
+# When several processes share a mix, how many blocks may each work ahead of the output?
+MIXAHEAD = 2
+
+# When a mix is made in segments (see mixFilesSegmented), how long (in seconds) is each?
+MIXSEGMENT = 300
+
+# ...and how many seconds of the mix before and after each segment go through MIXPOST
+# with it? MIXPOST's filters (dynaudnorm especially) adapt to what comes before,
+# and look ahead to what comes after.
+MIXPREROLL = 30
+
+# ...and for how many seconds does each segment fade into the next?
+MIXCROSSFADE = 1
+
+# When streaming, for how long (shortest and longest, in seconds) does each voice play
+# before another takes its place?
+STREAMVOICELIFE = (20, 120)
+
+# How many seconds of audio does the stream produce at a time? This is also
+# roughly how far ahead of real time it runs.
+STREAMBLOCK = 0.1
+
+# How many seconds of the stream may a listener (see openStreamOutput) fall behind
+# before it is dropped, so that it can't hold up everyone else?
+STREAMBACKLOG = 2
+
+# How long (in seconds) is each step of the loudness envelope kept for every file
+# by analyseDirectory?
+ANALYSISWINDOW = 0.1
+
+# Below what level (in dB from full scale) is a step of that envelope silent? This
+# should be the level at which PROCORIG and PROCPITCH remove silence.
+SILENCETHRESHOLD = -50
+
+# Over how many seconds do PROCORIG and PROCPITCH measure that level? This should be
+# the window of their silenceremove filters (0.02 unless they say otherwise).
+SILENCEWINDOW = 0.02
+
+# What is the packed sample store (see buildSampleStore) called, in a directory that has one?
+SAMPLESTORE = "chorus-samples"
 
-TEMPLOCATION="E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/tmp"
+# When Chorus changes pitch itself, how many input samples go into each output sample,
+# and into how many phases is the space between two input samples divided?
+RESAMPLETAPS = 32
+RESAMPLEPHASES = 512
+
+# How many FFmpeg processes (or other jobs) may run at once?
+# None means one per processor core, plus more for jobs that spend time waiting for the disk.
+WORKERS = None
+
+# When files are encoded for distribution by encodeJobs, how many may be read from
+# the disk at once? (The number of encoders is set by WORKERS.) Fewer suits a
+# spinning disk, which slows down when it is asked for several files at a time.
+DISKREADERS = 4
+
+# How many more times is a job tried if it fails for a reason that might go away,
+# such as running out of memory or of open files?
+RETRIES = 2
+
+# When jobs are shared out through a queue (see runWorker), for how many seconds
+# may a worker go without being heard from before its job is given to another?
+QUEUELEASE = 60
+
+# What, in a failed job's error output, shows that the failure might go away?
+TRANSIENTERRORS = ["Resource temporarily unavailable", "Too many open files", "Cannot allocate memory", "Device or resource busy"]
+
+# What is the file called, in each directory Chorus writes to, that records how each
+# file there was made? (It lets files that are already up to date be left alone.)
+MANIFEST = "chorus-manifest.json"
+
+# Which number seeds Chorus's random choices of pitches, volumes, durations and mixes?
+# The same seed and the same files always give the same results. None chooses
+# a new seed for every run, and logs it, so that the run can be repeated.
+SEED = None
+
+# Where shall temporary files be stored? None means a "chorus" directory in the
+# system's own place for them. Put them somewhere visible if you wish to debug them.
+TEMPLOCATION = None
+
+# Where shall the cache of audio durations, sample rates and channel counts be kept?
+# It is safe to delete this file: it is rebuilt as files are probed again.
+# None means "chorus-metadata.sqlite" in TEMPLOCATION.
+METADATACACHE = None
 
 # End of user-definable variables
 #################################
 
 
-import logging, random, math, argparse, subprocess, json, os, concurrent.futures, itertools, pprint, copy, tempfile, string
+import logging, math, argparse, subprocess, json, os, concurrent.futures, itertools, pprint, copy, tempfile, string, sqlite3, struct, threading
+import mmap, collections, wave, time, traceback, errno, hashlib, socket, sys, functools, shlex, shutil, contextlib, atexit, multiprocessing
+import asyncio
+import numpy
+
+# multiprocessing.parent_process (see startProfile) and socket.create_server
+# (see openStreamOutput) first appeared in Python 3.8
+if sys.version_info < (3, 8):
+    raise ImportError("Chorus needs Python 3.8 or later")
+
+try:
+    import resource
+except ImportError:
+    # Windows has no limit on open files that matters to us here
+    resource = None
 
 logging.basicConfig(level=logging.DEBUG, format='%(funcName)s - %(levelname)s - %(message)s')
 
-# Make sure our temporary files will work
-os.makedirs(TEMPLOCATION, exist_ok=True)
-tempfile.tempdir=TEMPLOCATION
+# While profiling (see startProfile), what has been recorded so far; None when not profiling
+profileState = None
+# The job each thread is doing, so that what a job's FFmpeg process does is counted against its stage
+profileThread = threading.local()
+# What span() returns when not profiling: nothing to do, and nothing to pay for
+NOPROFILE = contextlib.nullcontext()
+
+def startProfile(traceFile=None):
+    # Starts recording where the time goes: spans of Python work, every subprocess's
+    # wall and processor time and peak memory, FFmpeg's own report of its speed, and
+    # files, bytes and seconds of audio made by each stage. stopProfile() reports it.
+    # Profiling can also be started with the --profile option, or by setting the
+    # environment variable CHORUS_PROFILE to the name of the trace file.
+    global profileState
+    profileState = {'TraceFile': traceFile, 'Start': time.perf_counter(), 'Events': list(),
+                    'Counters': collections.defaultdict(lambda: collections.defaultdict(float)), 'Lock': threading.Lock()}
+    return()
+
+def stopProfile():
+    # Stops profiling, writes the trace file (in Chrome's trace format: load it at
+    # chrome://tracing or ui.perfetto.dev) if one was named, logs the summary table
+    # and returns it
+    global profileState
+    if profileState is None:
+        return(None)
+    state = profileState
+    profileState = None
+    if state['TraceFile']:
+        with open(state['TraceFile'], "w") as handle:
+            json.dump({'traceEvents': state['Events'], 'displayTimeUnit': "ms"}, handle)
+    summary = profileSummary(state)
+    logging.info("Profile:\n%s" % summary)
+    return(summary)
+
+def profileEvent(event):
+    # Adds an event (a dictionary in Chrome's trace format, with the time it began,
+    # ts, in seconds from the start of profiling) to the profile
+    event['ts'] = event['ts'] * 1e6
+    event.setdefault('pid', os.getpid())
+    event.setdefault('tid', threading.get_ident())
+    profileState['Events'].append(event)
+    return()
+
+def profileCount(stage, counter, amount=1):
+    # Adds to one of a stage's counters, if profiling
+    if profileState is None:
+        return()
+    with profileState['Lock']:
+        profileState['Counters'][stage][counter] += amount
+    return()
+
+def span(name, stage="python", **details):
+    # A context manager that times what happens inside it, if profiling:
+    #     with span("probe", "metadata", files=len(fileList)):
+    #         ...
+    if profileState is None:
+        return(NOPROFILE)
+    return(profileSpan(name, stage, details))
+
+@contextlib.contextmanager
+def profileSpan(name, stage, details):
+    state = profileState
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - startTime
+        if state is not None and profileState is state:
+            profileEvent({'name': name, 'cat': stage, 'ph': "X", 'ts': startTime - state['Start'], 'dur': duration * 1e6, 'args': details})
+            profileCount(stage, "Spans")
+            profileCount(stage, "Wall", duration)
+
+def profiled(stage):
+    # Makes every call of the function it decorates a span (see span), when profiling
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*arguments, **keywords):
+            if profileState is None:
+                return(function(*arguments, **keywords))
+            with profileSpan(function.__name__, stage, {}):
+                return(function(*arguments, **keywords))
+        return(wrapper)
+    return(decorate)
+
+def profileSummary(state):
+    # A table of what each stage did, from the counters of a profile
+    lines = ["%-16s %7s %10s %10s %10s %8s %9s %10s %9s" % ("Stage", "Spans", "Wall", "Processes", "CPU", "Peak MB", "Files", "MB", "Audio s")]
+    for stage, counters in sorted(state['Counters'].items()):
+        lines.append("%-16s %7d %10.2f %10d %10.2f %8.1f %9d %10.1f %9.1f" % (stage, counters['Spans'], counters['Wall'], counters['Processes'],
+                     counters['CPU'], counters['PeakRSS'] / 1e6, counters['Files'], counters['Bytes'] / 1e6, counters['AudioSeconds']))
+    return("\n".join(lines))
+
+def countOutputs(stage, outputs):
+    # Counts the files a job made, their size, and the seconds of audio in them
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    for outputFile in outputs:
+        if not isinstance(outputFile, str) or not os.path.isfile(outputFile):
+            continue
+        profileCount(stage, "Files")
+        profileCount(stage, "Bytes", os.path.getsize(outputFile))
+        header = readWavHeader(outputFile)
+        if header is not None:
+            profileCount(stage, "AudioSeconds", header['Duration'])
+    return()
+
+# Profiling can be switched on from outside for a whole run (but not again in
+# each process that a run starts for itself)
+if os.environ.get("CHORUS_PROFILE") and multiprocessing.parent_process() is None:
+    startProfile(os.environ["CHORUS_PROFILE"])
+    atexit.register(stopProfile)
+
+def temporaryLocation():
+    # The directory for temporary files (see TEMPLOCATION), made if need be
+    location = TEMPLOCATION or os.path.join(tempfile.gettempdir(), "chorus")
+    os.makedirs(location, exist_ok=True)
+    return(location)
+
+@functools.lru_cache(maxsize=None)
+def findProgram(directory, name):
+    # The full path of a program, looked for first in the directory and then
+    # wherever the system looks for programs. It is only looked for once.
+    candidates = [name + ".exe", name] if os.name == "nt" else [name]
+    for candidate in candidates:
+        path = os.path.join(directory, candidate)
+        if directory and os.path.isfile(path) and os.access(path, os.X_OK):
+            return(path)
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError("Cannot find %s in %s or anywhere else; please set FFMPEG" % (name, directory))
+    return(path)
+
+def ffmpegProgram(name):
+    # The full path of "ffmpeg" or "ffprobe" (see FFMPEG)
+    return(findProgram(FFMPEG, name))
+
+def ffmpegCommand(*arguments):
+    # The list of arguments that runs FFmpeg with the arguments given. FFmpeg is
+    # told not to read the keyboard, so that its standard input is free for
+    # audio or filter scripts (see runFFmpeg).
+    return([ffmpegProgram("ffmpeg"), "-nostdin", "-hide_banner"] + list(arguments))
+
+def runFFmpeg(command, input=None, stdout=subprocess.DEVNULL):
+    # Runs a command (a list of arguments; no shell is involved), sending 'input'
+    # (text or bytes, or an iterable of bytes to be written as they are made), if there
+    # is any, to its standard input: a filter script too long for a command line, say,
+    # given to FFmpeg as "-filter_complex_script pipe:0".
+    # Nothing is left behind in temporary files. Returns the CompletedProcess,
+    # with the command's standard error.
+    if isinstance(input, str):
+        input = input.encode("utf-8")
+    if profileState is None and input is None:
+        return(subprocess.run(command, stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.PIPE))
+    if profileState is None and isinstance(input, bytes):
+        return(subprocess.run(command, input=input, stdout=stdout, stderr=subprocess.PIPE))
+    return(runWatched(command, input, stdout))
+
+def runWatched(command, input, stdout):
+    # Does the work of runFFmpeg when the input is made a piece at a time, or when
+    # profiling: then the process's processor time and peak memory are recorded
+    # (where the system can tell us them), and so is FFmpeg's own report of its
+    # progress, which it is asked to write to a pipe of its own
+    progressRead = progressWrite = None
+    if profileState is not None and hasattr(os, "wait4") and os.path.basename(command[0]).startswith("ffmpeg"):
+        progressRead, progressWrite = os.pipe()
+        command = command[:1] + ["-progress", "pipe:%d" % progressWrite] + command[1:]
+    startTime = time.perf_counter()
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL if input is None else subprocess.PIPE, stdout=stdout,
+                               stderr=subprocess.PIPE, pass_fds=(progressWrite,) if progressWrite is not None else ())
+    if progressWrite is not None:
+        os.close(progressWrite)
+    collected = {'Speed': None}
+
+    def readAll(key, handle):
+        collected[key] = handle.read()
+
+    def readProgress():
+        # FFmpeg writes blocks of key=value lines, each ending with progress=continue (or end)
+        label = os.path.basename(command[-1])
+        with open(progressRead, "r", errors="replace") as handle:
+            for line in handle:
+                key, _, value = line.strip().partition("=")
+                if key == "speed" and value.endswith("x"):
+                    try:
+                        collected['Speed'] = float(value[:-1])
+                    except ValueError:
+                        continue
+                    if profileState is not None:
+                        profileEvent({'name': "FFmpeg speed", 'cat': "ffmpeg", 'ph': "C",
+                                      'ts': time.perf_counter() - profileState['Start'], 'args': {label: collected['Speed']}})
+
+    def writeInput():
+        try:
+            for chunk in ([input] if isinstance(input, bytes) else input):
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # The process has stopped reading; its return code will say why
+            pass
+        except BaseException as error:
+            collected['Error'] = error
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    threads = [threading.Thread(target=readAll, args=("Stderr", process.stderr))]
+    if stdout == subprocess.PIPE:
+        threads.append(threading.Thread(target=readAll, args=("Stdout", process.stdout)))
+    if progressRead is not None:
+        threads.append(threading.Thread(target=readProgress))
+    if input is not None:
+        threads.append(threading.Thread(target=writeInput))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    usage = None
+    if hasattr(os, "wait4") and profileState is not None:
+        # wait4 tells us the resources used by this one process, where
+        # getrusage would add up all the children together
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    else:
+        process.wait()
+    wall = time.perf_counter() - startTime
+
+    if profileState is not None:
+        stage = getattr(profileThread, "stage", None) or "subprocess"
+        details = {'command': " ".join(command[:1] + [os.path.basename(command[-1])]), 'returncode': process.returncode}
+        profileCount(stage, "Processes")
+        if usage is not None:
+            # Linux gives the peak memory in kilobytes, macOS in bytes
+            peak = usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+            details.update({'user': usage.ru_utime, 'system': usage.ru_stime, 'maxrss': peak})
+            profileCount(stage, "CPU", usage.ru_utime + usage.ru_stime)
+            with profileState['Lock']:
+                counters = profileState['Counters'][stage]
+                counters['PeakRSS'] = max(counters['PeakRSS'], peak)
+        if collected['Speed'] is not None:
+            details['speed'] = collected['Speed']
+        profileEvent({'name': os.path.basename(command[0]), 'cat': stage, 'ph': "X", 'ts': startTime - profileState['Start'],
+                      'dur': wall * 1e6, 'args': details})
+    if 'Error' in collected:
+        raise collected['Error']
+    return(subprocess.CompletedProcess(command, process.returncode, collected.get('Stdout'), collected['Stderr']))
 
 def ffmpegEscape(input):
     return(input.replace("\\", "\\\\").replace(":", "\\:").replace("'", "\\'"))
 
-def makeDurList(time, shortest=2, longest=10):
+# The seed of this run (see SEED), once it has been chosen
+seedState = {'Seed': None}
+seedLock = threading.Lock()
+
+def setSeed(seed=None):
+    # Sets the seed from which every random stream (see randomStream) is made.
+    # None chooses one at random.
+    if seed is None:
+        seed = int.from_bytes(os.urandom(8), "little") >> 1
+    with seedLock:
+        seedState['Seed'] = int(seed)
+    logging.info("Random seed is %d" % seed)
+    return(seed)
+
+def currentSeed():
+    # The seed of this run, taken from SEED (or chosen) the first time it is needed
+    with seedLock:
+        seed = seedState['Seed']
+    if seed is None:
+        with seedLock:
+            if seedState['Seed'] is None:
+                seedState['Seed'] = SEED if SEED is not None else int.from_bytes(os.urandom(8), "little") >> 1
+                logging.info("Random seed is %d" % seedState['Seed'])
+            seed = seedState['Seed']
+    return(seed)
+
+def randomStream(stage, name, seed=None):
+    # Returns a NumPy random number generator of its own for one stage ("pitch",
+    # "render", "mix" ...) of one file, made from the seed of the run and a hash of
+    # the stage and name. So any file can be made again by itself, in any order,
+    # by any process on any machine, and will come out the same as long as the
+    # seed is. Names should be given without their directories, so that they
+    # are the same wherever the files are kept. A seed may be given instead of the run's.
+    if seed is None:
+        seed = currentSeed()
+    key = hashlib.sha256(("%s\0%s" % (stage, name)).encode("utf-8")).digest()
+    return(numpy.random.Generator(numpy.random.PCG64(numpy.random.SeedSequence([seed] + list(struct.unpack("<8I", key))))))
+
+def makeDurations(timeList, shortest=2, longest=10, rng=None):
+    # Does what makeDurList does for every total time in timeList at once, with
+    # a single draw of random numbers. Returns (offsets, ends): the durations
+    # for timeList[i] end at ends[offsets[i]:offsets[i+1]], counting from 0,
+    # and the last of them ends exactly at timeList[i].
+    if rng is None:
+        rng = numpy.random.default_rng()
+    timeList = numpy.asarray(timeList, dtype=numpy.float64)
+    if len(timeList) == 0:
+        return(numpy.zeros(1, dtype=numpy.int64), numpy.zeros(0))
+    # No time can need more durations than this (one is spare, for rounding)
+    most = (timeList // shortest).astype(numpy.int64) + 2
+    starts = numpy.concatenate(([0], numpy.cumsum(most)))
+    ends = numpy.cumsum(rng.uniform(shortest, longest, starts[-1]))
+    # Count each time's durations from its own start
+    ends -= numpy.repeat(numpy.concatenate(([0], ends))[starts[:-1]], most)
+    # makeDurList keeps drawing while the total is no more than the time, so it
+    # keeps every duration ending within the time, and the one after that
+    counts = numpy.add.reduceat((ends <= numpy.repeat(timeList, most)).astype(numpy.int64), starts[:-1]) + 1
+    rank = numpy.arange(starts[-1]) - numpy.repeat(starts[:-1], most)
+    ends = ends[rank < numpy.repeat(counts, most)]
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+    ends[offsets[1:] - 1] = timeList
+    return(offsets, ends)
+
+def makeDurList(time, shortest=2, longest=10, rng=None):
     # logging.debug("Durations totalling %s to be calculated" % time)
-
-    durList = list()
-    totalDur = 0
-    while totalDur <= time:
-        duration = random.uniform(shortest, longest)
-        durList.append(duration)
-        totalDur += duration
-        # logging.debug("Appending %s seconds" % duration)
-
-    overTime = totalDur - time
-    durList[-1] -= overTime
+    offsets, ends = makeDurations([time], shortest, longest, rng)
+    durList = numpy.diff(ends, prepend=0).tolist()
 
     #logging.debug("List of durations:" % durList)
     #logging.debug("Check: total durations in list is %s" % sum(durList))
     return(durList) 
 
-def makeVolumeList(count, quietest=-24, loudest=0):
+def makeLevels(count, quietest=-24, loudest=0, rng=None):
+    # The volumes of makeVolumeList as an array of shape (count, CHANNELS), in dB
+    if rng is None:
+        rng = numpy.random.default_rng()
+    levels = rng.uniform(quietest, loudest, (count, CHANNELS))
+    # Some of the volumes need to be set to zero
+    levels[rng.random(count) > 0.5] = -numpy.inf
+    return(levels)
+
+def makeVolumeList(count, quietest=-24, loudest=0, rng=None):
     # These are multichannel values
-    volumeList = [None] * count
-    for i in range(count):
-        volumeList[i] = [None] * CHANNELS
-        for c in range(CHANNELS):
-            volumeList[i][c] = random.uniform(quietest, loudest)
-            # Some of the volumes need to be set to zero
-        if random.random() > 0.5:
-            for c in range(CHANNELS):
-                volumeList[i][c] = 0 - math.inf
+    volumeList = makeLevels(count, quietest, loudest, rng).tolist()
     # logging.debug("List of volumes: %s" % volumeList)
     return(volumeList)
 
-def makePitchList(count, lowest=1/20, highest=1/2):
-    pitchList = [None] * count
-    for i in range(count):
-        pitchList[i] = random.uniform(lowest, highest) * SAMPLERATE
+def makePitchList(count, lowest=1/20, highest=1/2, rng=None):
+    if rng is None:
+        rng = numpy.random.default_rng()
+    pitchList = (rng.uniform(lowest, highest, count) * SAMPLERATE).tolist()
     #logging.debug("List of pitches: %s" % pitchList)
     return(pitchList)
 
+def readWavHeader(filename):
+    # Reads the header of an uncompressed PCM or floating-point WAV file (such as the
+    # ones Chorus writes for itself) without starting any subprocess at all.
+    # Returns None if the file is not a WAV file we understand, in which case
+    # the caller should ask ffprobe instead.
+    try:
+        with open(filename, "rb") as handle:
+            riff = handle.read(12)
+            if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+                return(None)
+            fileSize = os.fstat(handle.fileno()).st_size
+            header = None
+            while True:
+                chunk = handle.read(8)
+                if len(chunk) < 8:
+                    return(None)
+                chunkId, chunkSize = struct.unpack("<4sI", chunk)
+                if chunkId == b"fmt ":
+                    fmt = handle.read(chunkSize + (chunkSize & 1))
+                    audioFormat, channels, sampleRate, byteRate, blockAlign, bits = struct.unpack("<HHIIHH", fmt[0:16])
+                    # WAVE_FORMAT_EXTENSIBLE keeps the real format in its sub-format GUID
+                    if audioFormat == 0xFFFE and len(fmt) >= 26:
+                        audioFormat = struct.unpack("<H", fmt[24:26])[0]
+                    # 1 is integer PCM, 3 is IEEE floating point
+                    if audioFormat not in (1, 3) or blockAlign == 0:
+                        return(None)
+                    header = {'Format': audioFormat, 'SampleRate': sampleRate, 'Channels': channels, 'BlockAlign': blockAlign, 'Bits': bits}
+                elif chunkId == b"data":
+                    if header is None:
+                        return(None)
+                    dataOffset = handle.tell()
+                    # A file still being written (or written to a pipe) may claim
+                    # more data than is really there
+                    dataSize = min(chunkSize, fileSize - dataOffset)
+                    samples = dataSize // header['BlockAlign']
+                    header['DataOffset'] = dataOffset
+                    header['DurationTs'] = samples
+                    header['Duration'] = samples / header['SampleRate']
+                    return(header)
+                else:
+                    handle.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+    except (OSError, struct.error):
+        return(None)
+
+# NumPy sample types for the WAV formats we can map directly, keyed by (format, bits)
+WAVDTYPES = {(1, 8): numpy.uint8, (1, 16): numpy.dtype("<i2"), (1, 32): numpy.dtype("<i4"),
+             (3, 32): numpy.dtype("<f4"), (3, 64): numpy.dtype("<f8")}
+
+def wavSampleType(header):
+    # The NumPy sample type of a WAV file, from its header (see readWavHeader), or
+    # None if readWav can't map it
+    if header is None:
+        return(None)
+    dtype = WAVDTYPES.get((header['Format'], header['Bits']))
+    if dtype is None or numpy.dtype(dtype).itemsize * header['Channels'] != header['BlockAlign']:
+        return(None)
+    return(dtype)
+
+@profiled("decode")
+def readWav(filename):
+    # Opens a WAV file without decoding or copying it. Returns None for anything
+    # that isn't a WAV file we can map directly (so the caller can fall back to FFmpeg),
+    # otherwise a dictionary with keys Name, SampleRate, Channels, Samples and Frames.
+    # Frames is a read-only NumPy array of shape (Samples, Channels) whose memory
+    # is the file itself, mapped by the operating system, so slicing it reads
+    # only the pages that are touched.
+    header = readWavHeader(filename)
+    dtype = wavSampleType(header)
+    if dtype is None:
+        return(None)
+    with open(filename, "rb") as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    frames = numpy.frombuffer(mapped, dtype=dtype, count=header['DurationTs'] * header['Channels'], offset=header['DataOffset'])
+    return({'Name': filename, 'SampleRate': header['SampleRate'], 'Channels': header['Channels'],
+            'Samples': header['DurationTs'], 'Frames': frames.reshape(header['DurationTs'], header['Channels'])})
+
+def probeFile(filename):
+    # Asks ffprobe for the duration, sample rate and channel count of the first audio stream
+    command = [ffmpegProgram("ffprobe"), "-v", "quiet", "-hide_banner", "-print_format", "json", "-show_streams", "-show_format", "-select_streams", "a:0", filename]
+    jReturn = json.loads(subprocess.run(command, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE).stdout)
+    stream = jReturn['streams'][0]
+    # Some containers only know their duration at the format level
+    duration = float(stream.get('duration', jReturn['format'].get('duration', 0)))
+    durationTs = int(float(stream.get('duration_ts', round(duration * int(stream['sample_rate'])))))
+    #logging.debug("Found an audio track of duration %s seconds" % duration)
+    return({'Duration': duration, 'DurationTs': durationTs, 'SampleRate': int(stream['sample_rate']), 'Channels': int(stream['channels'])})
+
+# One connection to the metadata cache per thread, because sqlite3 connections
+# must not be shared between threads
+metadataConnections = threading.local()
+
+def metadataCache():
+    connection = getattr(metadataConnections, "connection", None)
+    if connection is None:
+        cacheFile = METADATACACHE or temporaryLocation() + "/chorus-metadata.sqlite"
+        os.makedirs(os.path.dirname(cacheFile) or ".", exist_ok=True)
+        connection = sqlite3.connect(cacheFile, timeout=60)
+        connection.execute("CREATE TABLE IF NOT EXISTS clips (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, "
+                           "duration REAL, duration_ts INTEGER, sample_rate INTEGER, channels INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash TEXT)")
+        # A cache made before analyses had a quietest level is simply started again
+        if "quietest" not in [column[1] for column in connection.execute("PRAGMA table_info(analysis)")]:
+            connection.execute("DROP TABLE IF EXISTS analysis")
+        connection.execute("CREATE TABLE IF NOT EXISTS analysis (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, window REAL, threshold REAL, "
+                           "quiet_window REAL, loudness REAL, peak REAL, silences TEXT, quietest REAL, envelope BLOB)")
+        connection.commit()
+        metadataConnections.connection = connection
+    return(connection)
+
+@profiled("metadata")
+def clipMetadata(fileList):
+    # Returns a dictionary, keyed by the file names given, of dictionaries with keys
+    # Duration (seconds), DurationTs (in the stream's time base), SampleRate and Channels.
+    # Results are kept on disk, keyed by path, modification time and size, so files
+    # that have not changed since they were last seen are never probed again.
+    # Misses are filled by reading WAV headers directly where possible, and the
+    # rest are probed by several ffprobe processes at once.
+    connection = metadataCache()
+    metadata = dict()
+    misses = list()
+    for fileName in fileList:
+        path = os.path.abspath(fileName)
+        status = os.stat(path)
+        row = connection.execute("SELECT mtime, size, duration, duration_ts, sample_rate, channels FROM clips WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == status.st_mtime_ns and row[1] == status.st_size:
+            metadata[fileName] = {'Duration': row[2], 'DurationTs': row[3], 'SampleRate': row[4], 'Channels': row[5]}
+        else:
+            misses.append((fileName, path, status))
+
+    toProbe = list()
+    for fileName, path, status in misses:
+        header = readWavHeader(path)
+        if header is None:
+            toProbe.append((fileName, path, status))
+        else:
+            metadata[fileName] = {key: header[key] for key in ('Duration', 'DurationTs', 'SampleRate', 'Channels')}
+
+    if toProbe:
+        logging.debug("Probing %d files" % len(toProbe))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 8) as executor:
+            for (fileName, path, status), result in zip(toProbe, executor.map(probeFile, [item[1] for item in toProbe])):
+                metadata[fileName] = result
+
+    # Remember everything we had to find out, in one transaction
+    if misses:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   [(path, status.st_mtime_ns, status.st_size, metadata[fileName]['Duration'], metadata[fileName]['DurationTs'],
+                                     metadata[fileName]['SampleRate'], metadata[fileName]['Channels']) for fileName, path, status in misses])
+    return(metadata)
+
+def hashFile(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return(digest.hexdigest())
+
+@profiled("hash")
+def fileHashes(fileList):
+    # Returns a dictionary, keyed by the file names given, of the SHA-1 hash of each
+    # file's contents. Like clipMetadata, results are kept in the metadata cache, so
+    # a file is only read again when its modification time or size changes.
+    connection = metadataCache()
+    hashes = dict()
+    misses = list()
+    for fileName in fileList:
+        path = os.path.abspath(fileName)
+        status = os.stat(path)
+        row = connection.execute("SELECT mtime, size, hash FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == status.st_mtime_ns and row[1] == status.st_size:
+            hashes[fileName] = row[2]
+        else:
+            misses.append((fileName, path, status))
+    if misses:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 8) as executor:
+            for (fileName, path, status), digest in zip(misses, executor.map(hashFile, [item[1] for item in misses])):
+                hashes[fileName] = digest
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                                   [(path, status.st_mtime_ns, status.st_size, hashes[fileName]) for fileName, path, status in misses])
+    return(hashes)
+
+def sampleScale(dtype):
+    # The offset and scale that turn samples of this type into floating point with
+    # full scale 1.0
+    dtype = numpy.dtype(dtype)
+    if dtype.kind == "i":
+        return(0, 2 ** (8 * dtype.itemsize - 1))
+    if dtype.kind == "u":
+        return(2 ** (8 * dtype.itemsize - 1), 2 ** (8 * dtype.itemsize - 1))
+    return(0, 1)
+
+def pcm16Units(dtype):
+    # The offset and factor that turn samples of this type into the units of 16-bit
+    # samples (full scale 32768), which is what the mixer adds up: (sample - offset) * factor
+    offset, scale = sampleScale(dtype)
+    return(offset, 32768 / scale)
+
+def analyseSamples(frames, sampleRate):
+    # Summarises a signal (integer PCM, or floating point with full scale 1.0, of shape
+    # (samples, channels) or (samples,)). Returns a dictionary with keys:
+    # Envelope: the level of every ANALYSISWINDOW seconds, in dB from full scale,
+    #     as a float32 array (the power of all channels together, so a step is
+    #     silent only if every channel is)
+    # Loudness: the level of the whole signal in dB, leaving out silence and quiet
+    #     passages by gating 400ms blocks as EBU R128 does (but without its K-weighting)
+    # Peak: the highest sample in dB
+    # Silences: a list of [start, end] times, in seconds, of every run of steps
+    #     below SILENCETHRESHOLD
+    # Quietest: the level in dB of the quietest SILENCEWINDOW of any channel, measured
+    #     at every sample as silenceremove measures it (and at the beginning of the
+    #     signal over what there is of it so far), so that silenceremove finds nothing
+    #     to remove unless this is below SILENCETHRESHOLD (see hasSilence)
+    frames = numpy.asarray(frames)
+    if frames.ndim == 1:
+        frames = frames[:, None]
+    offset, scale = sampleScale(frames.dtype)
+    window = max(1, int(round(ANALYSISWINDOW * sampleRate)))
+    steps = -(-len(frames) // window)
+    power = numpy.zeros(steps, dtype=numpy.float64)
+    peak = 0.0
+    quietWindow = max(1, int(round(SILENCEWINDOW * sampleRate)))
+    quietest = numpy.inf
+    # The squares of the last samples of the block before, for windows that span two blocks
+    carry = numpy.zeros((0, frames.shape[1]))
+    # A hundred steps at a time, so that long files don't need much memory
+    for first in range(0, steps, 100):
+        block = frames[first * window:(first + 100) * window].astype(numpy.float32)
+        block -= offset
+        block /= scale
+        if len(block):
+            peak = max(peak, float(numpy.abs(block).max()))
+        channelSquares = numpy.concatenate((carry, numpy.square(block, dtype=numpy.float64)))
+        sums = numpy.concatenate((numpy.zeros((1, frames.shape[1])), numpy.cumsum(channelSquares, axis=0)))
+        if first == 0:
+            beginning = min(quietWindow - 1, len(channelSquares))
+            quietest = min(quietest, (sums[1:beginning + 1] / numpy.arange(1, beginning + 1)[:, None]).min(initial=numpy.inf))
+        quietest = min(quietest, ((sums[quietWindow:] - sums[:-quietWindow]) / quietWindow).min(initial=numpy.inf))
+        carry = channelSquares[len(channelSquares) - min(quietWindow - 1, len(channelSquares)):]
+        squares = numpy.square(block).mean(axis=1)
+        whole = len(squares) // window
+        power[first:first + whole] = squares[:whole * window].reshape(whole, window).mean(axis=1)
+        if len(squares) > whole * window:
+            power[first + whole] = squares[whole * window:].mean()
+    floor = 1e-12
+    envelope = (10 * numpy.log10(numpy.maximum(power, floor))).astype(numpy.float32)
+
+    # Gated loudness, from overlapping blocks of 400ms
+    blockSteps = max(1, int(round(0.4 / ANALYSISWINDOW)))
+    if steps >= blockSteps:
+        blocks = numpy.convolve(power, numpy.ones(blockSteps) / blockSteps, mode="valid")
+    else:
+        blocks = power[:1]
+    gated = blocks[blocks > 10 ** (-70 / 10)]
+    if len(gated):
+        gated = gated[gated > gated.mean() * 10 ** (-10 / 10)]
+    loudness = 10 * math.log10(max(gated.mean(), floor)) if len(gated) else 10 * math.log10(floor)
+
+    # Runs of silent steps
+    silent = numpy.concatenate(([False], envelope < SILENCETHRESHOLD, [False]))
+    edges = numpy.flatnonzero(numpy.diff(silent.astype(numpy.int8)))
+    duration = len(frames) / sampleRate
+    silences = [[float(start * ANALYSISWINDOW), float(min(end * ANALYSISWINDOW, duration))] for start, end in zip(edges[0::2], edges[1::2])]
+    return({'Envelope': envelope, 'Loudness': loudness, 'Peak': 20 * math.log10(max(peak, math.sqrt(floor))), 'Silences': silences,
+            'Quietest': 10 * math.log10(max(quietest, floor)) if len(frames) else 10 * math.log10(floor)})
+
+def analyseFile(filename):
+    # Summarises one file (see analyseSamples), reading it directly if it is a WAV
+    # file, or having FFmpeg decode it otherwise
+    wav = readWav(filename)
+    if wav is not None:
+        return(analyseSamples(wav['Frames'], wav['SampleRate']))
+    channels = clipMetadata([filename])[filename]['Channels']
+    samples = decodeToFloat(ffmpegCommand("-v", "error", "-i", filename, "-ar", str(SAMPLERATE), "-f", "f32le", "pipe:1"))
+    return(analyseSamples(samples.reshape(-1, channels), SAMPLERATE))
+
+@profiled("analysis")
+def fileAnalysis(fileList):
+    # Returns a dictionary, keyed by the file names given, of the summary of each
+    # file (see analyseSamples). Like clipMetadata, results are kept in the metadata
+    # cache, so a file is only read again when its modification time or size changes
+    # (or ANALYSISWINDOW, SILENCETHRESHOLD or SILENCEWINDOW do). Files are read several at once.
+    connection = metadataCache()
+    analysis = dict()
+    misses = list()
+    for fileName in fileList:
+        path = os.path.abspath(fileName)
+        status = os.stat(path)
+        row = connection.execute("SELECT mtime, size, window, threshold, quiet_window, loudness, peak, silences, quietest, envelope "
+                                 "FROM analysis WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0:5] == (status.st_mtime_ns, status.st_size, ANALYSISWINDOW, SILENCETHRESHOLD, SILENCEWINDOW):
+            analysis[fileName] = {'Envelope': numpy.frombuffer(row[9], dtype="<f4"), 'Loudness': row[5], 'Peak': row[6],
+                                  'Silences': json.loads(row[7]), 'Quietest': row[8]}
+        else:
+            misses.append((fileName, path, status))
+    if misses:
+        logging.debug("Analysing %d files" % len(misses))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount(0.25)) as executor:
+            for (fileName, path, status), result in zip(misses, executor.map(analyseFile, [item[1] for item in misses])):
+                analysis[fileName] = result
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(path, status.st_mtime_ns, status.st_size, ANALYSISWINDOW, SILENCETHRESHOLD, SILENCEWINDOW,
+                                     analysis[fileName]['Loudness'], analysis[fileName]['Peak'], json.dumps(analysis[fileName]['Silences']),
+                                     analysis[fileName]['Quietest'], analysis[fileName]['Envelope'].astype("<f4").tobytes())
+                                    for fileName, path, status in misses])
+    return(analysis)
+
+def analyseDirectory(pathname):
+    # Summarises every audio file in a directory (see analyseSamples), so that later
+    # stages can use the summaries without reading the files again, and returns
+    # them, keyed by the files' full names
+    fileList = [pathname + "/" + fileName for fileName in listAudioFiles(pathname)]
+    logging.info("Analysing %d files" % len(fileList))
+    return(fileAnalysis(fileList))
+
+def loudSeconds(analysis, duration):
+    # The whole seconds, from 0 to duration, at which a file with this analysis
+    # isn't silent for the second that follows
+    perSecond = max(1, int(round(1 / ANALYSISWINDOW)))
+    envelope = analysis['Envelope']
+    return([second for second in range(duration)
+            if envelope[second * perSecond:(second + 1) * perSecond].max(initial=-numpy.inf) >= SILENCETHRESHOLD])
+
+def matchingGain(analysis, loudness):
+    # The gain, in dB, that brings a file with this analysis to the given loudness,
+    # but never lifts its peak above full scale. Silent files are left alone.
+    if analysis['Loudness'] <= SILENCETHRESHOLD:
+        return(0.0)
+    return(min(loudness - analysis['Loudness'], -analysis['Peak']))
+
+def hasSilence(analysis):
+    # Whether the silenceremove filters of PROCORIG and PROCPITCH might find
+    # anything to remove from a file with this analysis
+    return(analysis['Quietest'] < SILENCETHRESHOLD)
+
 def clipLength(filename):
-    dos_command=[FFMPEG+"ffprobe.exe", "-v", "quiet", "-hide_banner", "-print_format", "json", "-show_streams", "-select_streams", "a:0", filename]
-    jReturn = json.loads(subprocess.run(dos_command, check=True, stdout=subprocess.PIPE).stdout)
-    duration = jReturn['streams'][0]['duration']
+    duration = clipMetadata([filename])[filename]['Duration']
     #logging.debug("Found an audio track of duration %s seconds" % duration)
     return(int(float(duration)))
 
 def clipLengthSamples(filename):
-    dos_command=[FFMPEG+"ffprobe.exe", "-v", "quiet", "-hide_banner", "-print_format", "json", "-show_streams", "-select_streams", "a:0", filename]
-    jReturn = json.loads(subprocess.run(dos_command, check=True, stdout=subprocess.PIPE).stdout)
-    duration = jReturn['streams'][0]['duration_ts']
+    duration = clipMetadata([filename])[filename]['DurationTs']
     #logging.debug("Found an audio track of duration %s samples" % duration)
     return(int(float(duration)))
 
@@ -132,7 +878,348 @@ def deltaVolFormula(v1, v2, t1, t2):
     formula = "'if(between(t,%.1f,%.1f),%.0fdB-((%.0fdB-%.0fdB)/(%.1f-%.1f))*(%.1f-t),1)':eval=frame" % (t1, t2, v1, v2, v1, t2, t1, t1)
     return(formula)
 
-def standardiseDirectory(pathname, destination="%s/PROCESSED"):
+@profiled("manifest")
+def readManifest(directory):
+    # Returns the manifest of a directory: a dictionary, keyed by the name of each
+    # file Chorus made there, of dictionaries with keys Stage, Source (the file it was
+    # made from), SourceHash, Filter (everything about the processing that could
+    # change its result) and Parameters (the random choices that went into it).
+    try:
+        with open(directory + "/" + MANIFEST, encoding="utf-8") as handle:
+            return(json.load(handle))
+    except FileNotFoundError:
+        return(dict())
+
+@profiled("manifest")
+def writeManifest(directory, manifest):
+    # Written to a new file first, so an interrupted run never leaves half a manifest.
+    # Kept compact, as a large render list rewrites it every few seconds
+    temporaryName = directory + "/" + MANIFEST + ".new"
+    with open(temporaryName, "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle, separators=(',', ':'))
+    os.replace(temporaryName, directory + "/" + MANIFEST)
+    return()
+
+def manifestEntry(stage, source, sourceHash, filter, parameters):
+    # The seed is kept too, so that a file's random choices can be made again
+    return({'Stage': stage, 'Source': os.path.abspath(source), 'SourceHash': sourceHash, 'Filter': filter, 'Parameters': parameters,
+            'Seed': currentSeed()})
+
+def isUpToDate(manifest, directory, outputName, sourceHash, filter):
+    # Was this output made, and still exists, from the same source by the same processing?
+    entry = manifest.get(outputName)
+    return(entry is not None and entry['SourceHash'] == sourceHash and entry['Filter'] == filter
+           and os.path.exists(directory + "/" + outputName))
+
+def manifestRecorder(manifests, entries):
+    # Returns a progress function for runJobs that adds to the manifests (a dictionary of
+    # manifests keyed by directory) the entries for each job that succeeds. entries is keyed
+    # by job name; each item is a list of (directory, output name, manifest entry), or a
+    # function that is given the job's result and returns such a list.
+    # The manifests are saved every few seconds, so an interrupted run loses little.
+    saved = [time.monotonic()]
+    def record(result):
+        if result['ReturnCode'] != 0 or result['Name'] not in entries:
+            return()
+        jobEntries = entries[result['Name']]
+        if callable(jobEntries):
+            jobEntries = jobEntries(result)
+        for directory, outputName, entry in jobEntries:
+            manifests[directory][outputName] = entry
+        if time.monotonic() - saved[0] > 5:
+            writeManifests(manifests)
+            saved[0] = time.monotonic()
+        return()
+    return(record)
+
+def writeManifests(manifests):
+    for directory, manifest in manifests.items():
+        writeManifest(directory, manifest)
+    return()
+
+def workerCount(ioWeight=0.0):
+    # How many jobs to run at once. ioWeight is the fraction of its time a job
+    # spends waiting for the disk rather than using a processor (0 to 1), so
+    # jobs that mostly wait are allowed to run several to a core.
+    if WORKERS:
+        return(WORKERS)
+    cores = os.cpu_count() or 1
+    return(max(1, int(round(cores / (1 - min(ioWeight, 0.9))))))
+
+def runJob(job, retries):
+    # Runs one job (see runJobs) and returns a dictionary describing what happened,
+    # with keys Name, Stage, Command, ReturnCode, Stderr, Output, Attempts and Time.
+    result = {'Name': job['Name'], 'Stage': job.get('Stage'), 'Command': None, 'ReturnCode': None,
+              'Stderr': "", 'Output': None, 'Attempts': 0, 'Time': 0}
+    startTime = time.monotonic()
+    if profileState is not None:
+        profileThread.stage = job.get('Stage')
+    with span(job['Name'], job.get('Stage') or "job"):
+        runAttempts(job, retries, result)
+    result['Time'] = time.monotonic() - startTime
+    if profileState is not None and result['ReturnCode'] == 0:
+        countOutputs(job.get('Stage') or "job", result['Output'] if result['Output'] is not None else (result['Command'] or [None])[-1])
+    return(result)
+
+def runAttempts(job, retries, result):
+    # Tries a job (see runJob) until it succeeds, fails for good or runs out of tries,
+    # filling in its result
+    for attempt in range(retries + 1):
+        result['Attempts'] = attempt + 1
+        transient = False
+        try:
+            if 'Function' in job:
+                result['Output'] = job['Function']()
+                result['ReturnCode'] = 0
+            else:
+                command = job['Command']
+                # A command may be left to be worked out when the job runs, which is
+                # necessary when it depends on a file an earlier job has to make
+                if callable(command):
+                    command = command()
+                # Some commands come with text for their standard input
+                input = None
+                if isinstance(command, tuple):
+                    command, input = command
+                result['Command'] = command
+                completed = runFFmpeg(command, input)
+                result['ReturnCode'] = completed.returncode
+                # FFmpeg can be very talkative; the end is where the error will be
+                result['Stderr'] = completed.stderr.decode("utf-8", "replace")[-4000:]
+                # A negative return code means the process was killed by a signal
+                transient = completed.returncode < 0 or any(message in result['Stderr'] for message in TRANSIENTERRORS)
+        except OSError as error:
+            result['ReturnCode'] = None
+            result['Stderr'] = str(error)
+            transient = error.errno in (errno.EAGAIN, errno.EMFILE, errno.ENFILE, errno.ENOMEM, errno.EBUSY)
+        except Exception:
+            result['ReturnCode'] = None
+            result['Stderr'] = traceback.format_exc()
+        if result['ReturnCode'] == 0 or not transient or attempt == retries:
+            break
+        logging.warning("%s failed (%s); trying again" % (job['Name'], result['Stderr'].strip().splitlines()[-1:]))
+        time.sleep(attempt + 1)
+    return()
+
+def runJobs(jobList, ioWeight=0.0, retries=None, progress=None):
+    # Runs a list of jobs in parallel, and returns a list of results (see runJob)
+    # in the same order. Each job is a dictionary with keys:
+    # Name      unique name of the job
+    # Command   FFmpeg command (a list of arguments, or a pair of that and the text
+    #           to send to its standard input; or a function returning either) to run, or
+    # Function  function to call instead of running a command
+    # Stage     (optional) which stage of processing the job belongs to
+    # After     (optional) list of the names of jobs that must succeed first
+    # A job starts as soon as the jobs it waits for have finished, whichever stage
+    # they belong to. If one of them fails, the job is skipped (and its result
+    # has the key Skipped). Each result is logged as it arrives, and given to the
+    # progress function if there is one.
+    if retries is None:
+        retries = RETRIES
+    names = set(job['Name'] for job in jobList)
+    waitingFor = dict()
+    dependents = collections.defaultdict(list)
+    ready = collections.deque()
+    for job in jobList:
+        # Names of jobs not in this list are taken to have been done already
+        after = [name for name in job.get('After', []) if name in names]
+        waitingFor[job['Name']] = len(after)
+        for name in after:
+            dependents[name].append(job)
+        if not after:
+            ready.append(job)
+
+    results = dict()
+    def skip(job):
+        results[job['Name']] = {'Name': job['Name'], 'Stage': job.get('Stage'), 'Command': None, 'ReturnCode': None,
+                                'Stderr': "", 'Output': None, 'Attempts': 0, 'Time': 0, 'Skipped': True}
+        logging.warning("Skipping %s because a job it needs failed" % job['Name'])
+        for dependent in dependents[job['Name']]:
+            if dependent['Name'] not in results:
+                skip(dependent)
+
+    workers = workerCount(ioWeight)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = dict()
+        while ready or running:
+            while ready:
+                job = ready.popleft()
+                if job['Name'] not in results:
+                    running[executor.submit(runJob, job, retries)] = job
+            done, notDone = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                result = future.result()
+                results[job['Name']] = result
+                if result['ReturnCode'] == 0:
+                    logging.info("%s finished in %.2f seconds" % (job['Name'], result['Time']))
+                    for dependent in dependents[job['Name']]:
+                        waitingFor[dependent['Name']] -= 1
+                        if waitingFor[dependent['Name']] == 0:
+                            ready.append(dependent)
+                else:
+                    logging.error("%s failed after %.2f seconds (return code %s):\n%s" % (job['Name'], result['Time'], result['ReturnCode'], result['Stderr']))
+                    for dependent in dependents[job['Name']]:
+                        skip(dependent)
+                if progress is not None:
+                    progress(result)
+    return([results[job['Name']] for job in jobList])
+
+@functools.lru_cache(maxsize=8)
+def resampleKernel(cutoff):
+    # The table of filter coefficients used by resampleRate: one row of taps for each of
+    # RESAMPLEPHASES + 1 fractional positions between two input samples.
+    # The filter is a Kaiser-windowed sinc with its cutoff at 'cutoff' times the
+    # input's Nyquist frequency; when lowering the sample rate, the cutoff is
+    # lowered to match and the filter widens in proportion.
+    halfWidth = RESAMPLETAPS // 2
+    if cutoff < 1:
+        halfWidth = int(math.ceil(halfWidth / cutoff))
+    offsets = numpy.arange(-halfWidth + 1, halfWidth + 1)
+    fractions = numpy.arange(RESAMPLEPHASES + 1) / RESAMPLEPHASES
+    distance = offsets[None, :] - fractions[:, None]
+    beta = 8.6
+    window = numpy.i0(beta * numpy.sqrt(numpy.clip(1 - (distance / halfWidth) ** 2, 0, 1))) / numpy.i0(beta)
+    table = cutoff * numpy.sinc(cutoff * distance) * window
+    return(offsets, table.astype(numpy.float32))
+
+def resampleRate(signal, fromRate, toRate, maxSamples=None, blockLength=16384):
+    # Resamples a mono float32 signal from one (whole number) sample rate to another.
+    # Pitch variants are made by treating a SAMPLERATE recording as though it had a
+    # lower sample rate and resampling it back to SAMPLERATE, which is what
+    # asetrate followed by aresample does.
+    # Output sample n lies exactly n * fromRate / toRate input samples in, worked out
+    # in whole numbers so no error builds up over a long file; the filter
+    # coefficients for the fractional part come from a table, interpolated between
+    # neighbouring phases. Every block of output is one gather and one multiply.
+    cutoff = min(1.0, toRate / fromRate)
+    offsets, table = resampleKernel(cutoff)
+    outputLength = (len(signal) * toRate) // fromRate
+    if maxSamples is not None:
+        outputLength = min(outputLength, maxSamples)
+    # Pad so that every tap of every output sample falls inside the array
+    padding = len(offsets)
+    padded = numpy.concatenate([numpy.zeros(padding, numpy.float32), numpy.asarray(signal, numpy.float32), numpy.zeros(padding, numpy.float32)])
+    output = numpy.empty(outputLength, dtype=numpy.float32)
+    for start in range(0, outputLength, blockLength):
+        n = numpy.arange(start, min(start + blockLength, outputLength), dtype=numpy.int64)
+        position = n * fromRate
+        whole = position // toRate
+        # Which phase, and how far towards the next
+        phase = (position % toRate) * RESAMPLEPHASES / toRate
+        lower = phase.astype(numpy.int64)
+        weight = (phase - lower).astype(numpy.float32)[:, None]
+        coefficients = table[lower] * (1 - weight) + table[lower + 1] * weight
+        taps = padded[(whole + padding)[:, None] + offsets[None, :]]
+        output[start:start+len(n)] = numpy.einsum("ij,ij->i", taps, coefficients)
+    return(output)
+
+def writePcm16Wav(filename, frames, sampleRate, comment=None):
+    # Writes floating-point samples (full scale 1.0, shape (samples, channels) or (samples,))
+    # as a 16-bit WAV file, with a comment in its INFO list as FFmpeg's -metadata comment= writes
+    frames = numpy.asarray(frames)
+    if frames.ndim == 1:
+        frames = frames[:, None]
+    channels = frames.shape[1]
+    data = floatToPcm16(frames)
+    info = b""
+    if comment is not None:
+        text = comment.encode("utf-8") + b"\0"
+        if len(text) & 1:
+            text += b"\0"
+        info = b"INFO" + b"ICMT" + struct.pack("<I", len(text)) + text
+        info = b"LIST" + struct.pack("<I", len(info)) + info
+    fmt = struct.pack("<HHIIHH", 1, channels, sampleRate, sampleRate * channels * 2, channels * 2, 16)
+    with open(filename, "wb") as handle:
+        handle.write(b"RIFF" + struct.pack("<I", 4 + 8 + len(fmt) + len(info) + 8 + len(data)) + b"WAVE")
+        handle.write(b"fmt " + struct.pack("<I", len(fmt)) + fmt + info)
+        handle.write(b"data" + struct.pack("<I", len(data)))
+        handle.write(data)
+    return(filename)
+
+def pitchShiftFileNative(pathname, fileName, pitchList):
+    # Makes all the pitch variants of one standardized file in one go: the file is
+    # read (mapped) once, and each variant is a resampling of it, written
+    # where pitchShiftCommand would have written it. Unlike PROCPITCH, no second
+    # silenceremove is done, because PROCORIG has already removed the silence
+    # from standardized files. Returns the list of files written, or None if the file
+    # isn't a mono WAV that can be read directly.
+    source = readWav(pathname + '/' + fileName)
+    if source is None or source['Channels'] != 1:
+        return(None)
+    frames = source['Frames'][:, 0]
+    offset, scale = sampleScale(frames.dtype)
+    signal = frames.astype(numpy.float32)
+    signal -= offset
+    signal /= scale
+    written = list()
+    for pitch in pitchList:
+        # As with -t 14:00
+        variant = resampleRate(signal, int(pitch), SAMPLERATE, maxSamples=14 * 60 * SAMPLERATE)
+        written.append(writePcm16Wav(pitchShiftName(pathname, fileName, pitch), variant, SAMPLERATE, comment="via samplerate %d" % pitch))
+    return(written)
+
+def standardiseFilter():
+    # Everything about standardization that affects the file it makes
+    return(PROCORIG % SAMPLERATE + MONOCODEC + METADATA % SAMPLERATE)
+
+def pitchShiftFilter(pitch, engine="ffmpeg", trim=True):
+    # Everything about making a pitch variant that affects the file it makes
+    # (see pitchShiftAudioFilter for trim)
+    if engine == "numpy":
+        return("resampleRate %d to %d, %d taps, %d phases" % (pitch, SAMPLERATE, RESAMPLETAPS, RESAMPLEPHASES) + " -t 14:00 " + METADATA % pitch)
+    return(pitchShiftAudioFilter(pitch, trim) + MONOCODEC + " -t 14:00 " + METADATA % pitch)
+
+def renderFilter(render=None):
+    # Everything about rendering that affects the file it makes; sounds moved
+    # around the speakers (see makeSpatialNodes) are made differently
+    if render is not None and 'Azimuths' in render:
+        return("spatial: speakers at %s, fade %s seconds, step %d samples" % (SPEAKERLAYOUTS[render['Speakers']], FADE, PANSTEP))
+    return("volume envelope: %d channels, fade %s seconds" % (CHANNELS, FADE))
+
+def validPitchVariants(manifest, directory, source, sourceHash):
+    # The names of the pitch variants of a source that are already up to date
+    source = os.path.abspath(source)
+    # Variants made by either engine will do, and by FFmpeg with or without trimming
+    # (which only depends on the source)
+    return([outputName for outputName, entry in manifest.items() if entry['Stage'] == "pitch" and entry['Source'] == source
+            and any(isUpToDate(manifest, directory, outputName, sourceHash, pitchShiftFilter(entry['Parameters']['Pitch'], engine, trim))
+                    for engine, trim in (("ffmpeg", True), ("ffmpeg", False), ("numpy", True)))])
+
+def choosePitches(destination, fileName, variants, valid=()):
+    # The pitches for the pitch variants of a file (named without its directory),
+    # from the file's own random stream, leaving out those whose variants (named
+    # in 'valid') are already made, so that there are 'variants' altogether
+    pitchList = [pitch for pitch in makePitchList(variants, rng=randomStream("pitch", fileName))
+                 if os.path.basename(pitchShiftName(destination, fileName, pitch)) not in valid]
+    return(pitchList[:max(variants - len(valid), 0)])
+
+def standardiseCommand(pathname, fileName, destination):
+    # The FFmpeg command that converts one file to standard format
+    fullFileName = pathname + '/' + fileName
+    return(ffmpegCommand("-y", "-i", fullFileName, "-af", PROCORIG % SAMPLERATE) + shlex.split(MONOCODEC)
+           + shlex.split(METADATA % SAMPLERATE) + [destination + "/" + fileName + ".wav"])
+
+def pitchShiftAudioFilter(pitch, trim=True):
+    # PROCPITCH for one pitch. If trim is False, because the file is known to have no
+    # silence in it (see hasSilence), its silenceremove is left out: it would
+    # have had to read the whole file only to find nothing to remove.
+    audioFilter = PROCPITCH % (pitch, SAMPLERATE)
+    if not trim:
+        audioFilter = ",".join(part for part in audioFilter.split(",") if not part.strip().startswith("silenceremove")) or "anull"
+    return(audioFilter)
+
+def pitchShiftCommand(pathname, fileName, pitch, trim=True):
+    # The FFmpeg command that makes one pitch variant of a standardized file
+    # (see pitchShiftAudioFilter for trim)
+    fullFileName = pathname + '/' + fileName
+    return(ffmpegCommand("-y", "-i", fullFileName, "-af", pitchShiftAudioFilter(pitch, trim)) + shlex.split(MONOCODEC)
+           + ["-t", "14:00"] + shlex.split(METADATA % pitch) + [pitchShiftName(pathname, fileName, pitch)])
+
+def pitchShiftName(pathname, fileName, pitch):
+    return(pathname + "/" + os.path.splitext(fileName)[0] + "-%d" % pitch + ".wav")
+
+def standardiseDirectory(pathname, destination="%s/PROCESSED", incremental=True):
     destination = destination % pathname
     # Using parallel processing...
     # Go through a directory of audio files, and convert each to a file
@@ -140,53 +1227,168 @@ def standardiseDirectory(pathname, destination="%s/PROCESSED"):
     # Also (sadly, for reasons associated with the practicality of processing long
     # files requiring many volume variations) we truncate each file
     # to nine minutes.
+    # If incremental, files whose standardized version is up to date (according to the
+    # destination's manifest) are left alone.
+    # Returns the list of job results (see runJobs).
     
     os.makedirs(destination, exist_ok=True)
     
-    fileList = filterAudioFiles(os.listdir(pathname))
-    commands = list()
+    fileList = listAudioFiles(pathname)
+    manifest = readManifest(destination)
+    hashes = fileHashes([pathname + '/' + fileName for fileName in fileList])
+    jobs = list()
+    entries = dict()
 
     for fileName in fileList:
-        fullFileName = pathname + '/' + fileName
-        
+        sourceHash = hashes[pathname + '/' + fileName]
+        if incremental and isUpToDate(manifest, destination, fileName + ".wav", sourceHash, standardiseFilter()):
+            continue
         # First, original pitch
-        commands.append("\"" + FFMPEG + "ffmpeg\" -y -i \"%s\" " % fullFileName + " -af " + PROCORIG % SAMPLERATE + " " + MONOCODEC \
-                  + " " + METADATA % SAMPLERATE + "  \"" + destination + "/" + fileName + ".wav\"")
+        jobs.append({'Name': "standardise " + fileName, 'Stage': "standardise",
+                     'Command': standardiseCommand(pathname, fileName, destination)})
+        entries[jobs[-1]['Name']] = [(destination, fileName + ".wav", manifestEntry("standardise", pathname + '/' + fileName, sourceHash,
+                                                                                  standardiseFilter(), {'SampleRate': SAMPLERATE}))]
         
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        for command in commands:
-            # logging.debug(command)
-            try:
-                future = executor.submit(subprocess.call, command)
-            except Exception:
-                # logging.debug("This should never be reached")
-                pass
-    return()
+    logging.info("%d of %d files need standardizing" % (len(jobs), len(fileList)))
+    manifests = {destination: manifest}
+    results = runJobs(jobs, ioWeight=0.25, progress=manifestRecorder(manifests, entries))
+    writeManifests(manifests)
+    return(results)
 
-def pitchShiftDirectory(pathname, variants=8):
+def pitchShiftDirectory(pathname, variants=8, incremental=True, engine="ffmpeg"):
     # Now let's make the files at lower pitches
-    commands = list()
-    fileList = filterAudioFiles(os.listdir(pathname))
-
+    # If incremental, only as many variants are made of each file as are needed to
+    # bring the number that are up to date (according to the manifest) to 'variants',
+    # and files that are themselves pitch variants are not varied again.
+    # Engine is "ffmpeg" to run FFmpeg once for every variant, or "numpy" to
+    # make all the variants of each file at once with pitchShiftFileNative()
+    # (files it can't read are still given to FFmpeg).
+    # FFmpeg only looks for silence to remove in files whose analysis (see
+    # analyseDirectory) shows that they might have some; only files that are given
+    # to FFmpeg are analysed.
+    # Returns the list of job results (see runJobs).
+    jobs = list()
+    entries = dict()
+    manifest = readManifest(pathname)
+    fileList = [fileName for fileName in listAudioFiles(pathname)
+                if manifest.get(fileName, {}).get('Stage') != "pitch"]
+    hashes = fileHashes([pathname + '/' + fileName for fileName in fileList])
+
+    def ffmpegJobs(pitchLists):
+        # The jobs, and their manifest entries, that have FFmpeg make the pitch
+        # variants of each file in pitchLists (a dictionary of file names and pitches)
+        analysis = fileAnalysis([pathname + '/' + fileName for fileName in pitchLists])
+        for fileName, pitchList in pitchLists.items():
+            fullFileName = pathname + '/' + fileName
+            trim = hasSilence(analysis[fullFileName])
+            for pitch in pitchList:
+                outputName = os.path.basename(pitchShiftName(pathname, fileName, pitch))
+                jobs.append({'Name': "pitch %s" % outputName, 'Stage': "pitch",
+                             'Command': pitchShiftCommand(pathname, fileName, pitch, trim)})
+                entries[jobs[-1]['Name']] = [(pathname, outputName, manifestEntry("pitch", fullFileName, hashes[fullFileName],
+                                                                                  pitchShiftFilter(pitch, "ffmpeg", trim), {'Pitch': int(pitch)}))]
+
+    pitchLists = dict()
     for fileName in fileList:
         fullFileName = pathname + '/' + fileName
-        pitchList = makePitchList(variants)
-        for pitch in pitchList:
-            #commands.append("echo HELLO > output")
-            commands.append("\"" + FFMPEG + "ffmpeg\" -y -i \"%s\" " % fullFileName \
-                            + " -af " + PROCPITCH % (pitch, SAMPLERATE) + " " + MONOCODEC \
-                            + " -t 14:00 " + METADATA % pitch + " \"" + pathname + "/" + os.path.splitext(fileName)[0] + "-%d" % pitch + ".wav\"")
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        for command in commands:
-            # (command)
-            #subprocess.run(command)
-            try:
-                future = executor.submit(subprocess.run, command)
-            except Exception:
-                # logging.debug("This should never be reached")
-                pass
-    return()
+        valid = list()
+        if incremental:
+            valid = validPitchVariants(manifest, pathname, fullFileName, hashes[fullFileName])
+        pitchList = choosePitches(pathname, fileName, variants, valid)
+        if not pitchList:
+            continue
+        if engine == "numpy":
+            jobs.append({'Name': "pitch %s" % fileName, 'Stage': "pitch", 'File': fileName, 'Pitches': pitchList,
+                         'Function': lambda fileName=fileName, pitchList=pitchList: pitchShiftFileNative(pathname, fileName, pitchList)})
+            entries[jobs[-1]['Name']] = [(pathname, os.path.basename(pitchShiftName(pathname, fileName, pitch)),
+                                          manifestEntry("pitch", fullFileName, hashes[fullFileName], pitchShiftFilter(pitch, "numpy"),
+                                                        {'Pitch': int(pitch)})) for pitch in pitchList]
+        else:
+            pitchLists[fileName] = pitchList
+    if pitchLists:
+        ffmpegJobs(pitchLists)
+
+    logging.info("%d pitch jobs to do" % len(jobs))
+    manifests = {pathname: manifest}
+    recorder = manifestRecorder(manifests, entries)
+    def recordMade(result):
+        # A native job with no output has left its file for FFmpeg
+        if result['ReturnCode'] != 0 or result['Output'] is not None or 'Function' not in jobsByName[result['Name']]:
+            recorder(result)
+    jobsByName = {job['Name']: job for job in jobs}
+    results = runJobs(jobs, ioWeight=0.25, progress=recordMade)
+
+    # Anything the native engine couldn't read goes to FFmpeg
+    jobs = list()
+    pitchLists = {jobsByName[result['Name']]['File']: jobsByName[result['Name']]['Pitches'] for result in results
+                  if 'Function' in jobsByName[result['Name']] and result['ReturnCode'] == 0 and result['Output'] is None}
+    if pitchLists:
+        ffmpegJobs(pitchLists)
+    if jobs:
+        results += runJobs(jobs, ioWeight=0.25, progress=recorder)
+    writeManifests(manifests)
+    return(results)
+
+def processDirectory(pathname, variants=8, destination="%s/PROCESSED", incremental=True):
+    # Does what standardiseDirectory, pitchShiftDirectory, makeVolumeAndTimeNodeList and
+    # repitchRenderList do, one after the other, but as a single set of jobs: each
+    # file's pitch variants are made as soon as it has been standardized, and each
+    # variant is panned as soon as it has been made, so that no stage waits
+    # for the whole of the previous one to finish.
+    # If incremental, work whose results are up to date (according to the
+    # manifests) is left out, as it is by the separate stages.
+    # Returns the list of job results (see runJobs).
+    destination = destination % pathname
+    renderDestination = destination + "/VOLUMEPROCESSED"
+    os.makedirs(renderDestination, exist_ok=True)
+    manifests = {destination: readManifest(destination), renderDestination: readManifest(renderDestination)}
+    fileList = listAudioFiles(pathname)
+    hashes = fileHashes([pathname + "/" + fileName for fileName in fileList])
+    jobs = list()
+    entries = dict()
+    for fileName in fileList:
+        fullFileName = pathname + "/" + fileName
+        standardised = destination + "/" + fileName + ".wav"
+        standardiseJob = "standardise " + fileName
+        # Anything made from a file that is being made again is out of date
+        outOfDate = not (incremental and isUpToDate(manifests[destination], destination, fileName + ".wav",
+                                                    hashes[fullFileName], standardiseFilter()))
+        if outOfDate:
+            jobs.append({'Name': standardiseJob, 'Stage': "standardise",
+                         'Command': standardiseCommand(pathname, fileName, destination)})
+            entries[standardiseJob] = [(destination, fileName + ".wav", manifestEntry("standardise", fullFileName, hashes[fullFileName],
+                                                                                    standardiseFilter(), {'SampleRate': SAMPLERATE}))]
+            valid = list()
+            renderNames = [(standardised, standardiseJob)]
+        else:
+            standardisedHash = fileHashes([standardised])[standardised]
+            valid = validPitchVariants(manifests[destination], destination, standardised, standardisedHash)
+            renderNames = [(standardised, standardiseJob)] + [(destination + "/" + outputName, None) for outputName in valid]
+        for pitch in choosePitches(destination, fileName + ".wav", variants, valid):
+            outputName = os.path.basename(pitchShiftName(destination, fileName + ".wav", pitch))
+            pitchJob = "pitch %s" % outputName
+            jobs.append({'Name': pitchJob, 'Stage': "pitch", 'After': [standardiseJob],
+                         'Command': pitchShiftCommand(destination, fileName + ".wav", pitch)})
+            # The hash of the standardized file can't be known until it has been made
+            entries[pitchJob] = lambda result, outputName=outputName, pitch=pitch, standardised=standardised: [(destination, outputName,
+                manifestEntry("pitch", standardised, fileHashes([standardised])[standardised], pitchShiftFilter(pitch), {'Pitch': int(pitch)}))]
+            renderNames.append((destination + "/" + outputName, pitchJob))
+        for renderName, previousJob in renderNames:
+            outputName = os.path.basename(renderName)
+            if previousJob is None or (not outOfDate and previousJob == standardiseJob):
+                # The file to be rendered is already up to date; what about its render?
+                if incremental and isUpToDate(manifests[renderDestination], renderDestination, outputName,
+                                              fileHashes([renderName])[renderName], renderFilter()):
+                    continue
+            renderJob = "render " + outputName
+            jobs.append({'Name': renderJob, 'Stage': "render", 'After': [previousJob] if previousJob else [],
+                         'Command': lambda renderName=renderName: renderCommand(renderName)})
+            entries[renderJob] = lambda result, renderName=renderName: [(renderDestination, os.path.basename(renderName),
+                                    manifestEntry("render", renderName, fileHashes([renderName])[renderName], renderFilter(), {}))]
+    logging.info("%d jobs to do" % len(jobs))
+    results = runJobs(jobs, ioWeight=0.25, progress=manifestRecorder(manifests, entries))
+    writeManifests(manifests)
+    return(results)
 
 def filterAudioFiles(fileList):
     outputList = list()
@@ -195,6 +1397,185 @@ def filterAudioFiles(fileList):
             outputList.append(fileName)
     return(outputList)
 
+def listAudioFiles(pathname):
+    # The names of the audio files in a directory
+    with span("list " + pathname, "list"):
+        return(filterAudioFiles(os.listdir(pathname)))
+
+def makeVolumeAndTimeNodes(name, duration, rng=None):
+    # Makes the dictionary of volume and time nodes for one file (see
+    # makeVolumeAndTimeNodeList), given its name and its duration in whole seconds.
+    # The random choices come from the file's own stream (see randomStream)
+    # unless a generator is given; if they do, the dictionary keeps the seed, as Seed,
+    # so that it can be made again (see remakeRender).
+    fileDict = dict()
+    if rng is None:
+        fileDict['Seed'] = currentSeed()
+        rng = randomStream("render", os.path.basename(name), fileDict['Seed'])
+    # This is the position in the file we are dealing with
+    timePos = 0
+    fileDict['Name'] = name
+    fileDict['Duration'] = duration
+    durationList = makeDurList(fileDict['Duration'], rng=rng)
+
+    # Remember: volumeList is a list of lists; each list corresponds to
+    # the multiple channel values at each volume change point
+    # so these volumes also deal with panning
+    volumeList = makeVolumeList(len(durationList), rng=rng)
+
+    processedVolumeList = list()
+    # We're going to take each volume point except the start and the end points,
+    # and generate a new list incorporating not only these points, but
+    # fades of duration FADE between one point and the next.
+    # Remember: valueList contains a list, whose members are the channel volumes
+    for i, valueList in enumerate(volumeList):
+        if i == 0:
+            # There is no previous volume to append
+            processedVolumeList.append(valueList)
+        if i > 0:
+            # This takes the PREVIOUS volume, appends it to the processedVolumeList,
+            # then appends the CURRENT volume
+            processedVolumeList.append(volumeList[i-1])
+            processedVolumeList.append(valueList)
+    # At the end of the list of volumes, we need to add the last volume
+    # again, because this is the closing volume
+    processedVolumeList.append(valueList)
+    fileDict['Volumes'] = processedVolumeList
+    # logging.debug("Volumes: %s" % fileDict['Volumes'])
+
+    timesList = list()
+    # Now, using those volumes in processedVolumeList,
+    # we're going to generate a list of times where each volume
+    # is to be applied.
+    for i, time in enumerate(durationList):
+        if i == 0:
+            # There is no beginning time for this transition
+            # because this is the initial volume.
+            timesList.append(0)
+        # The OLD volume begins to be left FADE time before
+        # the NEW volume begins.
+        timePos += time
+        if i != len(durationList)-1:
+            # There's no fade at the end (-1 because the
+            # length of a list with a zeroeth element only
+            # is 1
+            timesList.append(timePos - FADE)
+        timesList.append(timePos)
+    fileDict['Times'] = timesList
+    return(fileDict)
+
+def vbapGains(azimuths, speakers):
+    # The gain of every speaker in SPEAKERLAYOUTS[speakers] for a sound at each of the
+    # given azimuths (in degrees), as an array of shape (len(azimuths), speakers).
+    # Each sound is panned between the two speakers either side of it, by
+    # two-dimensional vector base amplitude panning (VBAP), keeping the power constant.
+    layout = numpy.radians(numpy.asarray(SPEAKERLAYOUTS[speakers], dtype=numpy.float64)) % (2 * math.pi)
+    order = numpy.argsort(layout)
+    ring = layout[order]
+    theta = numpy.radians(numpy.asarray(azimuths, dtype=numpy.float64)) % (2 * math.pi)
+    upper = numpy.searchsorted(ring, theta, side="right") % len(ring)
+    lower = (upper - 1) % len(ring)
+    # Solving theta's direction = g1 * (lower speaker's) + g2 * (upper speaker's)
+    determinant = numpy.sin(ring[upper] - ring[lower])
+    determinant[determinant == 0] = 1
+    g1 = numpy.sin(ring[upper] - theta) / determinant
+    g2 = numpy.sin(theta - ring[lower]) / determinant
+    # Only one speaker, or a sound exactly at a speaker
+    g1[upper == lower] = 1
+    g2[upper == lower] = 0
+    norm = numpy.hypot(g1, g2)
+    gains = numpy.zeros((len(theta), speakers), dtype=numpy.float64)
+    rows = numpy.arange(len(theta))
+    gains[rows, order[lower]] += g1 / norm
+    gains[rows, order[upper]] += g2 / norm
+    return(gains)
+
+def makeSpatialNodes(name, duration, speakers, rng=None):
+    # Like makeVolumeAndTimeNodes, but rather than giving every channel a volume of
+    # its own, gives the sound one volume and moves it around the speakers of
+    # SPEAKERLAYOUTS[speakers] (8, 16 or 32): at the start, and at the
+    # end of each duration, the sound is at a new azimuth, and it glides from each to
+    # the next. As well as Times and Volumes (each speaker's volume at each time, so
+    # FFmpeg can still render it, with a straight line between each pair of
+    # times), the dictionary has keys Speakers, Levels (the sound's volume at each
+    # time, in dB) and Azimuths (where it is, in degrees), from which
+    # renderEnvelope() follows the path exactly.
+    if speakers not in SPEAKERLAYOUTS:
+        raise ValueError("There is no layout of %d speakers in SPEAKERLAYOUTS" % speakers)
+    seed = None
+    if rng is None:
+        seed = currentSeed()
+        rng = randomStream("spatial", os.path.basename(name), seed)
+    durationList = makeDurList(duration, rng=rng)
+    levels = rng.uniform(-24, 0, len(durationList))
+    # Some of the volumes need to be set to zero
+    levels[rng.random(len(durationList)) > 0.5] = -numpy.inf
+    # Each move is up to a quarter of the way round, either way
+    turns = numpy.concatenate(([rng.uniform(0, 360)], rng.uniform(-90, 90, len(durationList))))
+    ends = numpy.cumsum(durationList)
+
+    # The same times, and fades between volumes, as makeVolumeAndTimeNodes makes
+    times = [0]
+    levelList = [levels[0]]
+    for i in range(len(durationList)):
+        if i != len(durationList) - 1:
+            times.append(ends[i] - FADE)
+            levelList.append(levels[i])
+        times.append(ends[i])
+        levelList.append(levels[min(i + 1, len(levels) - 1)])
+    azimuths = numpy.interp(times, numpy.concatenate(([0], ends)), numpy.cumsum(turns))
+
+    fileDict = {'Name': name, 'Duration': duration, 'Speakers': speakers, 'Times': [float(time) for time in times],
+                'Levels': [float(level) for level in levelList], 'Azimuths': azimuths.tolist()}
+    if seed is not None:
+        fileDict['Seed'] = seed
+    with numpy.errstate(divide="ignore"):
+        fileDict['Volumes'] = (numpy.asarray(levelList)[:, None] + 20 * numpy.log10(vbapGains(azimuths, speakers))).tolist()
+    return(fileDict)
+
+def makeSpatialNodeList(pathname, speakers, destination="%s/VOLUMEPROCESSED"):
+    # Like makeVolumeAndTimeNodeList, but the sounds are moved around the ring of
+    # speakers SPEAKERLAYOUTS[speakers] (see makeSpatialNodes) rather than given a
+    # volume in each channel
+    destination = destination % pathname
+    os.makedirs(destination, exist_ok=True)
+    fileList = listAudioFiles(pathname)
+    metadata = clipMetadata([pathname + "/" + fileName for fileName in fileList])
+    return([makeSpatialNodes(pathname + "/" + fileName, int(metadata[pathname + "/" + fileName]['Duration']), speakers)
+            for fileName in fileList])
+
+def renderNodes(render):
+    # The nodes of a render (see makeVolumeAndTimeNodes and makeSpatialNodes) as
+    # lists, to be saved or sent to a worker
+    nodes = {'Times': numpy.asarray(render['Times']).tolist(), 'Volumes': numpy.asarray(render['Volumes']).tolist()}
+    if 'Azimuths' in render:
+        nodes.update({'Speakers': render['Speakers'], 'Levels': list(render['Levels']), 'Azimuths': list(render['Azimuths'])})
+    return(nodes)
+
+def renderParameters(render):
+    # What a manifest keeps about a render (see repitchRenderList). One made from its
+    # file's own random stream (so with a Seed) can be made again from its seed and
+    # duration (see remakeRender), so its nodes, which can be very many, aren't
+    # kept; any other keeps its nodes.
+    if 'Seed' not in render:
+        return(renderNodes(render))
+    parameters = {'Duration': render['Duration']}
+    if 'Azimuths' in render:
+        parameters['Speakers'] = render['Speakers']
+    return(parameters)
+
+def remakeRender(entry):
+    # The render (see makeVolumeAndTimeNodes and makeSpatialNodes) that a manifest
+    # entry made by repitchRenderList was made with
+    parameters = entry['Parameters']
+    if 'Times' in parameters:
+        return(dict(parameters, Name=entry['Source']))
+    rng = randomStream("spatial" if 'Speakers' in parameters else "render", os.path.basename(entry['Source']), entry['Seed'])
+    if 'Speakers' in parameters:
+        return(makeSpatialNodes(entry['Source'], parameters['Duration'], parameters['Speakers'], rng=rng))
+    return(makeVolumeAndTimeNodes(entry['Source'], parameters['Duration'], rng=rng))
+
+@profiled("plan")
 def makeVolumeAndTimeNodeList(pathname, destination="%s/VOLUMEPROCESSED"):
 # Now create a dictionary containing:
 # Filename
@@ -212,59 +1593,11 @@ def makeVolumeAndTimeNodeList(pathname, destination="%s/VOLUMEPROCESSED"):
     os.makedirs(destination, exist_ok=True)
 
     nodeList = list()
-    fileList = filterAudioFiles(os.listdir(pathname))
+    fileList = listAudioFiles(pathname)
+    # Find every duration at once, rather than one ffprobe per file
+    metadata = clipMetadata([pathname + "/" + fileName for fileName in fileList])
     for fileName in fileList:
-        fileDict = dict()
-        # This is the position in the file we are dealing with
-        timePos = 0
-        fileDict['Name'] = pathname + "/" + fileName
-        fileDict['Duration'] = clipLength(pathname + "/" + fileName)
-        durationList = makeDurList(fileDict['Duration'])
-
-        # Remember: volumeList is a list of lists; each list corresponds to
-        # the multiple channel values at each volume change point
-        # so these volumes also deal with panning
-        volumeList = makeVolumeList(len(durationList))
-
-        processedVolumeList = list()
-        # We're going to take each volume point except the start and the end points,
-        # and generate a new list incorporating not only these points, but
-        # fades of duration FADE between one point and the next.
-        # Remember: valueList contains a list, whose members are the channel volumes
-        for i, valueList in enumerate(volumeList):
-            if i == 0:
-                # There is no previous volume to append
-                processedVolumeList.append(valueList)
-            if i > 0:
-                # This takes the PREVIOUS volume, appends it to the processedVolumeList,
-                # then appends the CURRENT volume
-                processedVolumeList.append(volumeList[i-1])
-                processedVolumeList.append(valueList)
-        # At the end of the list of volumes, we need to add the last volume
-        # again, because this is the closing volume
-        processedVolumeList.append(valueList)
-        fileDict['Volumes'] = processedVolumeList
-        # logging.debug("Volumes: %s" % fileDict['Volumes'])
-
-        timesList = list()
-        # Now, using those volumes in processedVolumeList,
-        # we're going to generate a list of times where each volume
-        # is to be applied.
-        for i, time in enumerate(durationList):
-            if i == 0:
-                # There is no beginning time for this transition
-                # because this is the initial volume.
-                timesList.append(0)
-            # The OLD volume begins to be left FADE time before
-            # the NEW volume begins.
-            timePos += time
-            if i != len(durationList)-1:
-                # There's no fade at the end (-1 because the
-                # length of a list with a zeroeth element only
-                # is 1
-                timesList.append(timePos - FADE)
-            timesList.append(timePos)
-        fileDict['Times'] = timesList
+        fileDict = makeVolumeAndTimeNodes(pathname + "/" + fileName, int(metadata[pathname + "/" + fileName]['Duration']))
 
         # Append the command dictionary for this file to the overall list of nodes
         # nodeList.append(fileDict)
@@ -274,6 +1607,87 @@ def makeVolumeAndTimeNodeList(pathname, destination="%s/VOLUMEPROCESSED"):
         nodeList.append(fileDict)
     return(nodeList)
 
+@profiled("plan")
+def makeRenderPlan(pathname, destination="%s/VOLUMEPROCESSED", rng=None):
+    # Makes the same volume and time nodes as makeVolumeAndTimeNodeList, for every
+    # file in the directory at once, but keeps them in a few NumPy arrays rather
+    # than in lists of dictionaries, and without the nodes duplicated for fades:
+    #   Names      the file names
+    #   Durations  each file's duration, in whole seconds
+    #   Offsets    file i's volume changes are Ends[Offsets[i]:Offsets[i+1]]
+    #   Ends       the time each volume ends, counting from the start of its file
+    #   Levels     the volume of every channel, in dB, one row for each of Ends
+    # and the Fade and number of Channels they were made for.
+    # Each file's nodes are drawn from its own random stream, so they are the same
+    # as makeVolumeAndTimeNodes would make, and the Seed is kept in the plan.
+    # If a generator is given instead, the nodes of all the files are drawn from
+    # it at once, which is quicker for very many files.
+    # renderPlanNodes() turns one file's part of the plan into the nodes
+    # makeVolumeAndTimeNodes would have made; saveRenderPlan() keeps a plan so that
+    # it can be looked at, or rendered later (perhaps by other machines).
+    destination = destination % pathname
+    os.makedirs(destination, exist_ok=True)
+
+    fileList = [pathname + "/" + fileName for fileName in listAudioFiles(pathname)]
+    metadata = clipMetadata(fileList)
+    durations = numpy.array([int(metadata[fileName]['Duration']) for fileName in fileList], dtype=numpy.int64)
+    plan = {'Names': numpy.array(fileList, dtype=str), 'Durations': durations, 'Fade': FADE, 'Channels': CHANNELS}
+    if rng is None:
+        endsList = list()
+        levelsList = list()
+        for fileName, duration in zip(fileList, durations):
+            fileRng = randomStream("render", os.path.basename(fileName))
+            offsets, ends = makeDurations([duration], rng=fileRng)
+            endsList.append(ends)
+            levelsList.append(makeLevels(len(ends), rng=fileRng))
+        plan['Offsets'] = numpy.concatenate(([0], numpy.cumsum([len(ends) for ends in endsList], dtype=numpy.int64)))
+        plan['Ends'] = numpy.concatenate(endsList) if endsList else numpy.zeros(0)
+        plan['Levels'] = (numpy.concatenate(levelsList) if levelsList else numpy.zeros((0, CHANNELS))).astype(numpy.float32)
+        plan['Seed'] = currentSeed()
+    else:
+        plan['Offsets'], plan['Ends'] = makeDurations(durations, rng=rng)
+        plan['Levels'] = makeLevels(len(plan['Ends']), rng=rng).astype(numpy.float32)
+    return(plan)
+
+def saveRenderPlan(plan, filename):
+    # Saves a plan made by makeRenderPlan() as a compressed NumPy .npz file
+    numpy.savez_compressed(filename, **plan)
+    return(filename)
+
+def loadRenderPlan(filename):
+    # Reads a plan saved by saveRenderPlan()
+    with numpy.load(filename) as data:
+        plan = {key: data[key] for key in data.files}
+    plan['Fade'] = float(plan['Fade'])
+    plan['Channels'] = int(plan['Channels'])
+    if 'Seed' in plan:
+        plan['Seed'] = int(plan['Seed'])
+    return(plan)
+
+def renderPlanNodes(plan, index):
+    # Returns the volume and time nodes of one file of a plan, as makeVolumeAndTimeNodes
+    # would, except that the times and volumes are NumPy arrays
+    if plan['Channels'] != CHANNELS:
+        raise ValueError("The plan is for %d channels, not %d" % (plan['Channels'], CHANNELS))
+    first, last = plan['Offsets'][index], plan['Offsets'][index+1]
+    ends = plan['Ends'][first:last]
+    # The old volume is left FADE before each new one begins; there's no fade at the end
+    times = numpy.empty(2 * len(ends))
+    times[0] = 0
+    times[1:-1:2] = ends[:-1] - plan['Fade']
+    times[2:-1:2] = ends[:-1]
+    times[-1] = ends[-1]
+    return({'Name': str(plan['Names'][index]), 'Duration': int(plan['Durations'][index]), 'Times': times,
+            'Volumes': numpy.repeat(plan['Levels'][first:last], 2, axis=0)})
+
+def renderPlan(plan, engine="ffmpeg", incremental=True, indices=None, queue=None):
+    # Renders the files of a plan, or only those whose indices are given (so that
+    # several processes or machines can share one plan). See repitchRenderList.
+    if indices is None:
+        indices = range(len(plan['Names']))
+    return(repitchRenderList([renderPlanNodes(plan, index) for index in indices], engine, incremental, queue))
+
+@profiled("commands")
 def makeFFmpegVolumeCommands(fileDict):
     # Returns a list of lists, containing the strings required to pass to FFmpeg,
     # one string per channel, to adjust the volume levels as required
@@ -283,7 +1697,7 @@ def makeFFmpegVolumeCommands(fileDict):
     # Create per-channel lists of volumes
     timesList = fileDict["Times"]
     channel = 0
-    while channel < CHANNELS:
+    while channel < len(fileDict["Volumes"][0]):
         channelVolumesList = list()
         
         for volumeItem in fileDict["Volumes"]:
@@ -323,19 +1737,19 @@ def makeFFmpegVolumeCommands(fileDict):
         
     return(FFmpegVolumeCommands)
 
+@profiled("commands")
 def fullFFmpegCommand(filename, volumeCommands):
 
-    # Two things go on here. We create a filter whose commands get put into a file with a
-    # suitable temporary file name. Then we create an FFmpeg command to process the file
-    # whilst reading its filter commands from the temporary file we just created. This is to
-    # work around the limitation of DOS commands having a maximum of just 8191 characters.
-
-    command = "\"" + FFMPEG + "/ffmpeg\" -i \"" + filename + "\" -filter_complex_script \""
+    # Two things go on here. We create a filter script, and an FFmpeg command to process
+    # the file that reads the script from its standard input, because the script can be
+    # far longer than a command line may be. Returns the pair (command, script), which
+    # runJob (or runFFmpeg) knows how to run.
 
     script = ''
     # Split the audio into the required number of channels
-    script += "[0:a]aformat=sample_fmts=flt,asplit=" + str(CHANNELS)
-    for channel in range(CHANNELS):
+    channels = len(volumeCommands)
+    script += "[0:a]aformat=sample_fmts=flt,asplit=" + str(channels)
+    for channel in range(channels):
         channelLabel = "[" + str(channel) + "]"
         script += channelLabel
     script +=";"
@@ -358,81 +1772,885 @@ def fullFFmpegCommand(filename, volumeCommands):
     # Now the output of the volume commands must be recombined into the correct number of
     # output channels
 
-    for channel in range(CHANNELS):
+    for channel in range(channels):
         script += "[" + str(channel) + "op" + "]"
 
-    script += "amerge=inputs=" + str(CHANNELS) + "[out0]"
-
-    # Now write the script to a temporary file
-    tempHandle = tempfile.NamedTemporaryFile(delete=False)
-    name = tempHandle.name
-    logging.debug("Temp file is: %s" % name)
-    tempHandle.write(script.encode('utf-8'))
-    tempHandle.close()
-
-    command += name + "\" -map \"[out0]\" "
+    script += "amerge=inputs=" + str(channels) + "[out0]"
 
     # That's the filter done. Now to encode the audio.
     outputFile = os.path.dirname(filename) + "/VOLUMEPROCESSED/" + os.path.basename(filename)
-    command += COMPRESSEDCODEC + "\"%s\"" % outputFile
+    command = ffmpegCommand("-y", "-i", filename, "-filter_complex_script", "pipe:0", "-map", "[out0]") + shlex.split(COMPRESSEDCODEC) + [outputFile]
 
-    # parameters = {"Command": command, "Filter" : name}
     logging.debug("FFmpeg command is: %s" % command)
-    return(command)   
-
-def repitchRenderList(renderList):
-    commandsToRunList = list()
+    return(command, script)
+
+def floatToPcm16(block):
+    # Converts floating-point samples (full scale is 1.0) to 16-bit PCM bytes,
+    # rounding and clipping the way FFmpeg does
+    return(numpy.clip(numpy.rint(block * 32768), -32768, 32767).astype("<i2").tobytes())
+
+def envelopeGains(fileDict, times):
+    # Returns the gain of every channel at each of the given times (in seconds),
+    # as a float32 array of shape (len(times), CHANNELS).
+    # The chain of volume filters written by makeFFmpegVolumeCommands gives its
+    # levels in dB, but FFmpeg turns "-6dB" into an amplitude before any arithmetic
+    # happens, so each fade is a straight line in amplitude between two nodes.
+    # This does the same. (FFmpeg, with eval=frame, then holds each gain for a whole
+    # frame of a few thousand samples; here the gain moves every sample, so fades are
+    # free of steps.) After the last node the last level is held.
+    nodeTimes = numpy.asarray(fileDict['Times'], dtype=numpy.float64)
+    nodeGains = numpy.power(10, numpy.asarray(fileDict['Volumes'], dtype=numpy.float64) / 20)
+    gains = numpy.empty((len(times), nodeGains.shape[1]), dtype=numpy.float32)
+    for channel in range(nodeGains.shape[1]):
+        gains[:, channel] = numpy.interp(times, nodeTimes, nodeGains[:, channel])
+    return(gains)
+
+def spatialGains(fileDict, times):
+    # Like envelopeGains, for a sound moved around the speakers (see makeSpatialNodes):
+    # its volume and azimuth at each time, and from those the gain of every speaker
+    nodeTimes = numpy.asarray(fileDict['Times'], dtype=numpy.float64)
+    level = numpy.interp(times, nodeTimes, numpy.power(10, numpy.asarray(fileDict['Levels'], dtype=numpy.float64) / 20))
+    azimuth = numpy.interp(times, nodeTimes, numpy.asarray(fileDict['Azimuths'], dtype=numpy.float64))
+    return((level[:, None] * vbapGains(azimuth, fileDict['Speakers'])).astype(numpy.float32))
+
+def panBlock(block, start, sampleRate, fileDict):
+    # Pans a block of a mono signal, beginning 'start' samples into it, along the
+    # path of fileDict (see makeSpatialNodes), with one matrix multiplication.
+    # Every speaker's gain is only worked out every PANSTEP samples; each stretch
+    # of PANSTEP samples, weighted by how near each sample is to either end,
+    # is multiplied by the matrix of the gains at its two ends. The few stretches
+    # where the gains turn a corner, which a straight line between their ends would
+    # cut, are worked out sample by sample: those with a node of the path inside
+    # them, and those in which the sound passes a speaker (so that a different
+    # pair of speakers is sounding at either end).
+    steps = -(-len(block) // PANSTEP)
+    signal = numpy.zeros(steps * PANSTEP, dtype=numpy.float32)
+    signal[:len(block)] = block
+    signal = signal.reshape(steps, PANSTEP)
+    gains = spatialGains(fileDict, (start + numpy.arange(steps + 1) * PANSTEP) / sampleRate)
+    weight = numpy.arange(PANSTEP, dtype=numpy.float32) / PANSTEP
+    weighted = numpy.stack((signal * (1 - weight), signal * weight), axis=2)
+    matrices = numpy.stack((gains[:-1], gains[1:]), axis=1)
+    panned = numpy.matmul(weighted, matrices).reshape(steps * PANSTEP, -1)[:len(block)]
+    nodes = numpy.asarray(fileDict['Times'], dtype=numpy.float64) * sampleRate - start
+    nodes = nodes[(nodes > 0) & (nodes < len(block)) & (nodes % PANSTEP != 0)]
+    passing = numpy.flatnonzero(((gains[:-1] > 0) != (gains[1:] > 0)).any(axis=1))
+    corners = numpy.union1d((nodes // PANSTEP).astype(numpy.int64), passing)
+    if len(corners):
+        cornered = (corners[:, None] * PANSTEP + numpy.arange(PANSTEP)).ravel()
+        cornered = cornered[cornered < len(block)]
+        panned[cornered] = block[cornered, None] * spatialGains(fileDict, (start + cornered) / sampleRate)
+    return(panned)
+
+def renderEnvelope(fileDict):
+    # Does the work of makeFFmpegVolumeCommands and fullFFmpegCommand without FFmpeg:
+    # reads the mono file, multiplies it by every channel's volume envelope at
+    # once, and writes the multi-channel result to the VOLUMEPROCESSED directory.
+    # Returns the name of the file written, or None if the file isn't a mono
+    # WAV that can be read directly (so FFmpeg must be used instead).
+    source = readWav(fileDict['Name'])
+    if source is None or source['Channels'] != 1:
+        return(None)
+    outputFile = os.path.dirname(fileDict['Name']) + "/VOLUMEPROCESSED/" + os.path.basename(fileDict['Name'])
+    return(writeEnvelope(source['Frames'][:, 0], source['SampleRate'], fileDict, outputFile))
+
+def writeEnvelope(frames, sampleRate, fileDict, outputFile):
+    # Multiplies a mono signal (integer PCM of any width, or floating point with full
+    # scale 1.0; see sampleScale) by the volume envelope of every channel in fileDict, and writes the
+    # multi-channel result as a 16-bit WAV file. A sound moved around the
+    # speakers (see makeSpatialNodes) follows its path instead (see panBlock).
+    offset, scale = sampleScale(frames.dtype)
+    with wave.open(outputFile, "wb") as output:
+        output.setnchannels(len(fileDict['Volumes'][0]))
+        output.setsampwidth(2)
+        output.setframerate(sampleRate)
+        for start in range(0, len(frames), MIXBLOCK):
+            block = frames[start:start+MIXBLOCK].astype(numpy.float32)
+            block -= offset
+            block /= scale
+            if 'Azimuths' in fileDict:
+                output.writeframes(floatToPcm16(panBlock(block, start, sampleRate, fileDict)))
+                continue
+            times = numpy.arange(start, start + len(block)) / sampleRate
+            output.writeframes(floatToPcm16(block[:, None] * envelopeGains(fileDict, times)))
+    return(outputFile)
+
+def renderCommand(fileName):
+    # Makes new volume and time nodes for a file that may only just have been
+    # made, and returns the FFmpeg command that applies them
+    render = makeVolumeAndTimeNodes(fileName, clipLength(fileName))
+    return(fullFFmpegCommand(render['Name'], makeFFmpegVolumeCommands(render)))
+
+def repitchRenderList(renderList, engine="ffmpeg", incremental=True, queue=None):
+    # Engine is "ffmpeg" to apply the volume envelopes with chains of FFmpeg volume
+    # filters, or "numpy" to apply them with renderEnvelope(). Files that
+    # renderEnvelope() can't read are always given to FFmpeg.
+    # If queue is the name of a queue file (see runWorker), the files are rendered
+    # by the workers taking jobs from it, rather than here.
+    # If incremental, files whose rendered version is up to date (according to the
+    # VOLUMEPROCESSED manifest) are left alone, whatever their new volume nodes.
+    # Returns the list of job results (see runJobs).
+    manifests = dict()
+    entries = dict()
+    hashes = fileHashes([render['Name'] for render in renderList])
+    toRender = list()
+    for render in renderList:
+        directory = os.path.dirname(render['Name']) + "/VOLUMEPROCESSED"
+        if directory not in manifests:
+            manifests[directory] = readManifest(directory)
+        outputName = os.path.basename(render['Name'])
+        if incremental and isUpToDate(manifests[directory], directory, outputName, hashes[render['Name']], renderFilter(render)):
+            continue
+        toRender.append(render)
+        # Enough is kept to make the file again exactly (see remakeRender), but no
+        # more, so that saving the manifest as renders finish stays quick
+        entry = manifestEntry("render", render['Name'], hashes[render['Name']], renderFilter(render), renderParameters(render))
+        entry['Seed'] = render.get('Seed', entry['Seed'])
+        entries["render " + outputName] = [(directory, outputName, entry)]
+    logging.info("%d of %d files need rendering" % (len(toRender), len(renderList)))
+    renderList = toRender
+    recorder = manifestRecorder(manifests, entries)
+
+    if queue is not None:
+        # The workers are sent the volume nodes themselves, so they need make no random choices
+        results = runQueuedJobs(queue, [dict({'Name': "render " + os.path.basename(render['Name']), 'Kind': "render", 'Engine': engine,
+                                              'File': render['Name'], 'Duration': render['Duration']}, **renderNodes(render))
+                                        for render in renderList], progress=recorder)
+        writeManifests(manifests)
+        return(results)
+
+    results = list()
+    if engine == "numpy":
+        jobs = [{'Name': "render " + os.path.basename(render['Name']), 'Stage': "render",
+                 'Function': lambda render=render: renderEnvelope(render)} for render in renderList]
+        def recordRendered(result):
+            # A result with no output is a file left for FFmpeg, not yet rendered
+            if result['Output'] is not None:
+                recorder(result)
+        results = runJobs(jobs, progress=recordRendered)
+        renderList = [render for render, result in zip(renderList, results) if result['ReturnCode'] == 0 and result['Output'] is None]
+        results = [result for result in results if result['ReturnCode'] != 0 or result['Output'] is not None]
+
+    jobs = list()
     for render in renderList:
         commandList = makeFFmpegVolumeCommands(render)
         logging.debug("Processing %s" % render['Name'])
-        commandsToRunList.append(fullFFmpegCommand(render['Name'], commandList))
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        for command in commandsToRunList:
-            try:
-                future = executor.submit(subprocess.run, command)
-            except Exception:
-                # logging.debug("This should never be reached")
-                pass
+        jobs.append({'Name': "render " + os.path.basename(render['Name']), 'Stage': "render",
+                     'Command': fullFFmpegCommand(render['Name'], commandList)})
         
-    return()
-
-def multipleConvert(directory, bitrate=48):
+    results += runJobs(jobs, ioWeight=0.25, progress=recorder)
+    writeManifests(manifests)
+    return(results)
+
+def decodeToFloat(command, input=None):
+    # Runs an FFmpeg command that writes mono f32le to its standard output,
+    # and returns what it wrote as a NumPy array
+    result = runFFmpeg(command, input, stdout=subprocess.PIPE)
+    result.check_returncode()
+    return(numpy.frombuffer(result.stdout, dtype="<f4"))
+
+def fusedProcessFile(pathname, fileName, variants, destination, engine="ffmpeg"):
+    # Does the work of standardiseDirectory, pitchShiftDirectory and repitchRenderList
+    # for one source file, decoding it only once and writing only the finished,
+    # panned files. Returns the list of files written.
+    # Engine is "ffmpeg" to change pitch with FFmpeg, or "numpy" to use resampleRate().
+    fullFileName = pathname + '/' + fileName
+    logging.debug("Processing %s" % fullFileName)
+    standardised = decodeToFloat(ffmpegCommand("-v", "error", "-i", fullFileName, "-af", PROCORIG % SAMPLERATE,
+                                                "-ac", "1", "-f", "f32le", "pipe:1"))
+    written = list()
+    def write(outputName, frames):
+        # Each file is written as soon as it is made, so only one pitch variant
+        # is ever held in memory alongside the decoded source
+        fileDict = makeVolumeAndTimeNodes(destination + "/" + outputName, int(len(frames) / SAMPLERATE))
+        written.append(writeEnvelope(frames, SAMPLERATE, fileDict, destination + "/" + outputName))
+    # The names are the ones the three separate stages would have given the files
+    write(fileName + ".wav", standardised)
+    trim = hasSilence(analyseSamples(standardised, SAMPLERATE))
+    for pitch in makePitchList(variants, rng=randomStream("pitch", fileName + ".wav")):
+        if engine == "numpy":
+            write(fileName + "-%d" % pitch + ".wav", resampleRate(standardised, int(pitch), SAMPLERATE, maxSamples=14 * 60 * SAMPLERATE))
+            continue
+        # The pitch is changed by FFmpeg working on the decoded samples, which
+        # arrive through a pipe, so the source file isn't read again
+        pitched = decodeToFloat(ffmpegCommand("-v", "error", "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", "1", "-i", "pipe:0",
+                                              "-af", pitchShiftAudioFilter(pitch, trim), "-t", "14:00", "-f", "f32le", "pipe:1"),
+                                input=standardised.tobytes())
+        write(fileName + "-%d" % pitch + ".wav", pitched)
+        del pitched
+    return(written)
+
+def fusedProcessDirectory(pathname, variants=8, destination="%s/PROCESSED/VOLUMEPROCESSED", incremental=True, engine="ffmpeg"):
+    # One pass replacement for standardiseDirectory, pitchShiftDirectory,
+    # makeVolumeAndTimeNodeList and repitchRenderList. Each source is decoded and
+    # standardised once; its pitch variants are made from the decoded samples and
+    # panned straight away, and only the panned files are written, to the same
+    # place and with the same names as the separate stages would use.
+    # No PROCESSED files are kept.
+    # Returns the list of job results (see runJobs); the Output of each is the
+    # list of files written for one source.
+    destination = destination % pathname
+    os.makedirs(destination, exist_ok=True)
+    # If incremental, sources that already have 'variants' up to date pitch variants
+    # (according to the destination's manifest) are left alone.
+    fileList = listAudioFiles(pathname)
+    manifest = readManifest(destination)
+    hashes = fileHashes([pathname + "/" + fileName for fileName in fileList])
+    # Engine is passed to fusedProcessFile
+    if engine == "numpy":
+        pitchFilter = "resampleRate to %d, %d taps, %d phases" % (SAMPLERATE, RESAMPLETAPS, RESAMPLEPHASES)
+    else:
+        pitchFilter = PROCPITCH
+    fusedFilter = standardiseFilter() + " | " + pitchFilter + " | " + renderFilter()
+    jobs = list()
+    entries = dict()
+    for fileName in fileList:
+        fullFileName = os.path.abspath(pathname + "/" + fileName)
+        upToDate = [outputName for outputName, entry in manifest.items() if entry['Source'] == fullFileName
+                    and isUpToDate(manifest, destination, outputName, hashes[pathname + "/" + fileName], fusedFilter)]
+        if incremental and len(upToDate) > variants:
+            continue
+        jobs.append({'Name': "fused " + fileName, 'Stage': "fused",
+                     'Function': lambda fileName=fileName: fusedProcessFile(pathname, fileName, variants, destination, engine)})
+        entries[jobs[-1]['Name']] = lambda result, fileName=fileName: [(destination, os.path.basename(outputFile),
+            manifestEntry("fused", pathname + "/" + fileName, hashes[pathname + "/" + fileName], fusedFilter, {})) for outputFile in result['Output']]
+    manifests = {destination: manifest}
+    results = runJobs(jobs, progress=manifestRecorder(manifests, entries))
+    writeManifests(manifests)
+    return(results)
+
+def multipleConvert(directory, bitrate=48, incremental=True, engine="threads"):
     # Using parallel processes, encodes many files in one directory
     # quickly, for distribution
-    fileList = filterAudioFiles(os.listdir(directory))
-    commandList = list()
+    # Returns the list of job results (see runJobs).
+    # If incremental, files whose encoded version is up to date (according to the
+    # directory's manifest) are left alone.
+    # Engine is "threads" to run each encoder from a thread of its own (see runJobs),
+    # or "asyncio" to have encodeJobs run them all, feeding them from the disk
+    # only a few files at a time.
+    filter = "volume=-20dB,bass=f=400:g=-5,treble=f=200:g=15,treble=f=1800:g=10,dynaudnorm,bs2b"
+    manifest = readManifest(directory)
+    # Files this has encoded before are not encoded again
+    fileList = [file for file in listAudioFiles(directory) if manifest.get(file, {}).get('Stage') != "convert"]
+    hashes = fileHashes([directory + '/' + file for file in fileList])
+    jobs = list()
+    entries = dict()
     for file in fileList:
-        command = '"' + FFMPEG + '/ffmpeg" -i "' + directory + '/' + file + '" '
-        command += " -af volume=-20dB,bass=f=400:g=-5,treble=f=200:g=15,treble=f=1800:g=10,dynaudnorm,bs2b "
-        command += OUTPUTCODEC + ' "' + directory + '/' + file + '.opus"'
-        commandList.append(command)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        for command in commandList:
+        if incremental and isUpToDate(manifest, directory, file + '.opus', hashes[directory + '/' + file], filter + OUTPUTCODEC):
+            continue
+        if engine == "asyncio":
+            jobs.append({'Name': "convert " + file, 'Stage': "convert", 'Source': directory + '/' + file, 'Filter': filter,
+                         'Output': directory + '/' + file + '.opus'})
+        else:
+            command = ffmpegCommand("-y", "-i", directory + '/' + file, "-af", filter)
+            command += shlex.split(OUTPUTCODEC) + [directory + '/' + file + '.opus']
+            jobs.append({'Name': "convert " + file, 'Stage': "convert", 'Command': command})
+        entries[jobs[-1]['Name']] = [(directory, file + '.opus', manifestEntry("convert", directory + '/' + file, hashes[directory + '/' + file],
+                                                                             filter + OUTPUTCODEC, {}))]
+
+    logging.info("%d of %d files need encoding" % (len(jobs), len(fileList)))
+    manifests = {directory: manifest}
+    if engine == "asyncio":
+        results = encodeJobs(jobs, progress=manifestRecorder(manifests, entries))
+    else:
+        results = runJobs(jobs, ioWeight=0.1, progress=manifestRecorder(manifests, entries))
+    writeManifests(manifests)
+    return(results)
+
+def encodeCommand(job):
+    # The FFmpeg command for an encoding job (see encodeJobs), which reports its
+    # progress on its standard output
+    if 'Blocks' in job:
+        inputArguments = ["-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "-i", "pipe:0"]
+    elif job.get('Piped'):
+        inputArguments = ["-i", "pipe:0"]
+    else:
+        inputArguments = ["-i", job['Source']]
+    return(ffmpegCommand("-y", "-nostats", "-progress", "pipe:1", *inputArguments, "-af", job['Filter'])
+           + shlex.split(OUTPUTCODEC) + [job['Output']])
+
+async def encodeAsync(job, encoders, readers, encoded):
+    # Runs one encoding job (see encodeJobs) once one of the encoders is free, and
+    # returns its result. Its input is read a piece at a time, and only while one of
+    # the readers is free, and is written to the encoder only as fast as the encoder
+    # takes it. encoded[job['Name']] is kept up to date with the number of
+    # seconds encoded so far.
+    result = {'Name': job['Name'], 'Stage': job.get('Stage'), 'Command': None, 'ReturnCode': None,
+              'Stderr': "", 'Output': None, 'Attempts': 1, 'Time': 0}
+    loop = asyncio.get_running_loop()
+    async with encoders:
+        startTime = time.monotonic()
+        try:
+            # Finding FFmpeg can fail too, and should fail only this job
+            result['Command'] = encodeCommand(job)
+            process = await asyncio.create_subprocess_exec(*result['Command'], stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                stdin=asyncio.subprocess.PIPE if 'Blocks' in job or job.get('Piped') else asyncio.subprocess.DEVNULL)
+        except OSError as error:
+            result['Stderr'] = str(error)
+            return(result)
+
+        async def feed():
+            # From a mix (a block at a time, each made in a thread so that the encoders
+            # aren't held up), or from a file (a megabyte at a time)
+            if 'Blocks' in job:
+                blocks = iter(job['Blocks'])
+                read = lambda: next(blocks, b"")
+            elif job.get('Piped'):
+                handle = open(job['Source'], "rb")
+                read = lambda: handle.read(1 << 20)
+            else:
+                return()
             try:
-                future = executor.submit(subprocess.run, command)
-            except Exception:
-                pass
-            
+                while True:
+                    async with readers:
+                        chunk = await loop.run_in_executor(None, read)
+                    if not chunk:
+                        break
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # The encoder has stopped reading; its return code will say why.
+                # A mix it didn't finish lets go of its files now.
+                if 'Blocks' in job and hasattr(job['Blocks'], "close"):
+                    await loop.run_in_executor(None, job['Blocks'].close)
+            finally:
+                if job.get('Piped'):
+                    handle.close()
+                process.stdin.close()
+            return()
+
+        async def watch():
+            # FFmpeg's progress reports, a line at a time
+            async for line in process.stdout:
+                key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+                if key == "out_time_us" and value.isdigit():
+                    encoded[job['Name']] = int(value) / 1e6
+            return()
+
+        try:
+            stderr = (await asyncio.gather(feed(), watch(), process.stderr.read()))[2]
+        except Exception:
+            process.kill()
+            await process.wait()
+            result['Stderr'] = traceback.format_exc()
+            return(result)
+        result['ReturnCode'] = await process.wait()
+        # FFmpeg can be very talkative; the end is where the error will be
+        result['Stderr'] = stderr.decode("utf-8", "replace")[-4000:]
+        result['Time'] = time.monotonic() - startTime
+        if result['ReturnCode'] == 0:
+            result['Output'] = job['Output']
+    return(result)
+
+def encodeJobs(jobList, encoders=None, readers=None, progress=None):
+    # Encodes files for distribution with OUTPUTCODEC, many at once, from one thread.
+    # Each encoder is an FFmpeg process that is fed through a pipe, and only
+    # 'readers' (DISKREADERS if None) of them are read for at once, however many
+    # 'encoders' (see workerCount) are running. Each job is a dictionary with keys:
+    # Name      unique name of the job
+    # Source    file to encode, or
+    # Blocks    the samples to encode, as an iterable of f32le blocks at SAMPLERATE
+    #           with CHANNELS channels (such as mixStream gives)
+    # Filter    filters FFmpeg applies before encoding
+    # Output    file to write
+    # Stage     (optional) which stage of processing the job belongs to
+    # Duration  (optional) seconds of audio, for the progress reports
+    # WAV files are read by Chorus and piped to FFmpeg; other files, whose formats
+    # may need to be read out of order, are read by FFmpeg itself.
+    # Returns a list of results in the same order, as runJobs does; each result is
+    # logged as it arrives, and given to the progress function if there is one.
+    # Every few seconds, how much has been encoded so far is logged.
+    for job in jobList:
+        if 'Source' in job:
+            job['Piped'] = readWavHeader(job['Source']) is not None
+    durations = clipMetadata([job['Source'] for job in jobList if 'Source' in job and 'Duration' not in job])
+    total = sum(job.get('Duration') or durations[job['Source']]['Duration'] for job in jobList if 'Duration' in job or 'Source' in job)
+    encoded = dict()
+
+    async def encodeAll():
+        encoderLimit = asyncio.Semaphore(encoders or workerCount())
+        readerLimit = asyncio.Semaphore(readers or DISKREADERS)
+        results = dict()
+        async def encodeOne(job):
+            result = await encodeAsync(job, encoderLimit, readerLimit, encoded)
+            results[job['Name']] = result
+            if result['ReturnCode'] == 0:
+                logging.info("%s finished in %.2f seconds" % (job['Name'], result['Time']))
+            else:
+                logging.error("%s failed after %.2f seconds (return code %s):\n%s" % (job['Name'], result['Time'], result['ReturnCode'], result['Stderr']))
+            if progress is not None:
+                progress(result)
+        async def report():
+            while True:
+                await asyncio.sleep(5)
+                logging.info("Encoded %.0f of %.0f seconds of audio; %d of %d files finished" % (sum(encoded.values()), total, len(results), len(jobList)))
+        reporter = asyncio.ensure_future(report())
+        try:
+            await asyncio.gather(*[encodeOne(job) for job in jobList])
+        finally:
+            reporter.cancel()
+        return([results[job['Name']] for job in jobList])
+
+    return(asyncio.run(encodeAll()))
+
+def encodeMixes(directory, countList, renderDuration=3600, workers=1, store=False, avoidSilence=False, loudness=None, encoders=None):
+    # Makes a mix of each number of files in countList, as mixDirectoryFiles would
+    # (with the numpy engine), but sends each straight to an encoder (see encodeJobs),
+    # so that no uncompressed mix is written. Each mix is put through MIXPOST, and
+    # encoded with OUTPUTCODEC into the file that multipleConvert would have made of it.
+    # Each encoded mix is recorded in the directory's manifest as multipleConvert
+    # records its own, so that multipleConvert doesn't encode it again.
+    # Returns the list of job results.
+    sampleStore = openSampleStore(directory) if store else None
+    jobs = list()
+    entries = dict()
+    for i, count in enumerate(countList):
+        outputFile, fileDictionaryList = chooseMix(directory, count, renderDuration, countList[:i].count(count), None, avoidSilence, loudness)
+        jobs.append({'Name': "encode " + os.path.basename(outputFile), 'Stage': "convert", 'Filter': MIXPOST, 'Output': outputFile + '.opus',
+                     'Duration': renderDuration, 'Blocks': mixStream(directory, fileDictionaryList, renderDuration, workers, sampleStore)})
+        # The mix itself is never written, so there is no source to hash
+        entries[jobs[-1]['Name']] = [(directory, os.path.basename(outputFile) + '.opus', manifestEntry("convert", outputFile, None, MIXPOST + OUTPUTCODEC,
+                                                                                                        {'Count': count, 'Duration': renderDuration}))]
+    manifests = {directory: readManifest(directory)}
+    results = encodeJobs(jobs, encoders, progress=manifestRecorder(manifests, entries))
+    writeManifests(manifests)
+    return(results)
+
+
+# Held while files are counted and opened for a mix, so that mixes opening their
+# files at the same time (see encodeMixes) each make room for their own
+openFileLock = threading.Lock()
+
+def openFileCount():
+    # How many files this process has open, where the system can tell us
+    for directory in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return(len(os.listdir(directory)))
+        except OSError:
+            continue
+    return(0)
+
+def raiseOpenFileLimit(needed):
+    # Every memory-mapped file holds a file descriptor open, and a mix of
+    # thousands of files would otherwise run out of them. Makes room for
+    # 'needed' more than are open already.
+    if resource is None:
+        return()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = openFileCount() + needed + 256
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        if hard != resource.RLIM_INFINITY:
+            wanted = min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
     return()
 
-            
+def sampleStoreIndex(directory):
+    # The index of a directory's sample store, or None if it hasn't one
+    try:
+        with open(directory + "/" + SAMPLESTORE + ".json", encoding="utf-8") as handle:
+            return(json.load(handle))
+    except (OSError, ValueError):
+        return(None)
+
+def storeSamples(directory, fileName):
+    # The frames of one file as 16-bit samples at SAMPLERATE with CHANNELS channels:
+    # read straight from the file if it is already like that, or else decoded by FFmpeg
+    wav = readWav(directory + "/" + fileName)
+    if wav is not None and wav['SampleRate'] == SAMPLERATE and wav['Channels'] == CHANNELS and wav['Frames'].dtype == numpy.dtype("<i2"):
+        return(wav['Frames'])
+    completed = runFFmpeg(ffmpegCommand("-v", "error", "-i", directory + "/" + fileName, "-f", "s16le", "-ar", str(SAMPLERATE),
+                                        "-ac", str(CHANNELS), "pipe:1"), stdout=subprocess.PIPE)
+    completed.check_returncode()
+    return(numpy.frombuffer(completed.stdout, dtype="<i2").reshape(-1, CHANNELS))
+
+def buildSampleStore(directory, incremental=True):
+    # Packs every audio file in a directory (such as VOLUMEPROCESSED) into one
+    # large file of 16-bit frames at SAMPLERATE with CHANNELS channels, with an index
+    # of where each file begins, so that mixes (see mixDirectoryFiles) can read
+    # them all through a single memory map, without opening, seeking or decoding
+    # thousands of files again each time. Each file begins on a page boundary.
+    # If incremental, files already in the store, and unchanged since, are kept,
+    # and only new or changed files are added to the end; the store is packed
+    # afresh once more than half of it is taken up by old versions of files.
+    # Returns the index (see openSampleStore).
+    index = sampleStoreIndex(directory) if incremental else None
+    if index is not None and (index['SampleRate'] != SAMPLERATE or index['Channels'] != CHANNELS):
+        index = None
+    fileList = listAudioFiles(directory)
+    statistics = {fileName: os.stat(directory + "/" + fileName) for fileName in fileList}
+    current = dict()
+    if index is not None:
+        current = {fileName: entry for fileName, entry in index['Files'].items() if fileName in statistics
+                   and entry['MTime'] == statistics[fileName].st_mtime_ns and entry['Size'] == statistics[fileName].st_size}
+        used = sum(entry['Samples'] for entry in current.values()) * CHANNELS * 2
+        dataSize = os.path.getsize(directory + "/" + index['Data']) if os.path.exists(directory + "/" + index['Data']) else 0
+        if dataSize == 0 or used < dataSize / 2:
+            index = None
+            current = dict()
+    toAdd = [fileName for fileName in fileList if fileName not in current]
+    logging.info("%d of %d files to add to the sample store" % (len(toAdd), len(fileList)))
+    if index is None:
+        # A new data file, with a new name, so that mixes still reading the old one aren't disturbed
+        oldData = sampleStoreIndex(directory)
+        index = {'SampleRate': SAMPLERATE, 'Channels': CHANNELS, 'Format': "<i2",
+                 'Data': "%s-%s.pcm" % (SAMPLESTORE, os.urandom(4).hex()), 'Files': dict()}
+    else:
+        oldData = None
+    index['Files'] = current
+
+    with open(directory + "/" + index['Data'], "ab") as handle:
+        offset = handle.seek(0, os.SEEK_END)
+        # Decode a few files ahead of the one being written
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount(0.5)) as executor:
+            pending = collections.deque()
+            names = iter(toAdd)
+            for fileName in itertools.islice(names, workerCount(0.5) * 2):
+                pending.append((fileName, executor.submit(storeSamples, directory, fileName)))
+            while pending:
+                fileName, future = pending.popleft()
+                nextName = next(names, None)
+                if nextName is not None:
+                    pending.append((nextName, executor.submit(storeSamples, directory, nextName)))
+                try:
+                    frames = future.result()
+                except (OSError, ValueError, subprocess.CalledProcessError) as error:
+                    logging.warning("Cannot add %s to the sample store: %s" % (fileName, error))
+                    continue
+                padding = -offset % mmap.PAGESIZE
+                handle.write(b"\0" * padding)
+                offset += padding
+                handle.write(numpy.ascontiguousarray(frames).tobytes())
+                index['Files'][fileName] = {'Offset': offset, 'Samples': len(frames),
+                                            'MTime': statistics[fileName].st_mtime_ns, 'Size': statistics[fileName].st_size}
+                offset += frames.nbytes
+    temporaryName = directory + "/" + SAMPLESTORE + ".json.new"
+    with open(temporaryName, "w", encoding="utf-8") as handle:
+        json.dump(index, handle)
+    os.replace(temporaryName, directory + "/" + SAMPLESTORE + ".json")
+    if oldData is not None and oldData['Data'] != index['Data']:
+        try:
+            os.remove(directory + "/" + oldData['Data'])
+        except OSError:
+            pass
+    return(index)
+
+def openSampleStore(directory):
+    # Maps a directory's sample store (see buildSampleStore) into memory. Returns a
+    # dictionary with keys Directory, Files (the index) and Samples (every frame in
+    # the store, as one array of shape (frames, CHANNELS)), or None if there is no
+    # store suitable for mixing at SAMPLERATE with CHANNELS channels.
+    index = sampleStoreIndex(directory)
+    if index is None or index['SampleRate'] != SAMPLERATE or index['Channels'] != CHANNELS:
+        return(None)
+    dataFile = directory + "/" + index['Data']
+    if not os.path.exists(dataFile) or os.path.getsize(dataFile) == 0:
+        return(None)
+    samples = numpy.memmap(dataFile, dtype=index['Format'], mode="r")
+    return({'Directory': directory, 'Files': index['Files'], 'Samples': samples})
+
+def storeFrames(store, fileName):
+    # One file's frames from a sample store, without copying them, or None if
+    # the file isn't in the store or has changed since it was stored
+    entry = store['Files'].get(fileName)
+    if entry is None:
+        return(None)
+    try:
+        statistics = os.stat(store['Directory'] + "/" + fileName)
+    except OSError:
+        return(None)
+    if statistics.st_mtime_ns != entry['MTime'] or statistics.st_size != entry['Size']:
+        return(None)
+    start = entry['Offset'] // 2
+    return(store['Samples'][start:start + entry['Samples'] * CHANNELS].reshape(entry['Samples'], CHANNELS))
+
+def openMixVoices(directory, fileDictionaryList, cache=None, store=None):
+    # Maps every file chosen for a mix into memory, ready for mixVoicesBlock().
+    # Returns a list of dictionaries with keys Name, LoopPoint, Gain (in dB), Frames,
+    # LoopStart (in samples), and Offset and Factor (see pcm16Units).
+    # Files that aren't WAVs at SAMPLERATE with CHANNELS channels can't be mixed here,
+    # and are left out with a warning.
+    # If a cache dictionary is given, files already mapped are taken from it.
+    # If a sample store is given (see openSampleStore), files are taken from that
+    # when they are in it.
+    voices = list()
+    frames = dict()
+    if store is not None:
+        frames = {fileDictionary['Name']: storeFrames(store, fileDictionary['Name']) for fileDictionary in fileDictionaryList}
+        frames = {name: value for name, value in frames.items() if value is not None}
+    with openFileLock:
+        raiseOpenFileLimit(len(fileDictionaryList) - len(frames))
+        for fileDictionary in fileDictionaryList:
+            fileName = directory + "/" + fileDictionary['Name']
+            if fileDictionary['Name'] in frames:
+                wav = {'SampleRate': SAMPLERATE, 'Channels': CHANNELS, 'Samples': len(frames[fileDictionary['Name']]),
+                       'Frames': frames[fileDictionary['Name']]}
+            elif cache is None:
+                wav = readWav(fileName)
+            else:
+                if fileName not in cache:
+                    cache[fileName] = readWav(fileName)
+                wav = cache[fileName]
+            if wav is None or wav['SampleRate'] != SAMPLERATE or wav['Channels'] != CHANNELS or wav['Samples'] == 0:
+                logging.warning("Cannot mix %s without FFmpeg; leaving it out" % fileDictionary['Name'])
+                continue
+            loopStart = min(fileDictionary['LoopPoint'] * SAMPLERATE, wav['Samples'] - 1)
+            offset, factor = pcm16Units(wav['Frames'].dtype)
+            voices.append({'Name': fileDictionary['Name'], 'LoopPoint': fileDictionary['LoopPoint'], 'Gain': fileDictionary.get('Gain', 0),
+                           'Frames': wav['Frames'], 'LoopStart': loopStart, 'Offset': offset, 'Factor': factor})
+    return(voices)
+
+def mixableFiles(directory, fileDictionaryList, store=None):
+    # The files of fileDictionaryList that openMixVoices would mix, found from their
+    # headers (or the sample store) without mapping any of them, so that a process
+    # about to start workers doesn't hand every one of them down to each worker.
+    # Returns a list of dictionaries with keys Name, LoopPoint and Gain.
+    mixable = list()
+    for fileDictionary in fileDictionaryList:
+        if store is None or storeFrames(store, fileDictionary['Name']) is None:
+            header = readWavHeader(directory + "/" + fileDictionary['Name'])
+            if wavSampleType(header) is None or header['SampleRate'] != SAMPLERATE or header['Channels'] != CHANNELS or header['DurationTs'] == 0:
+                logging.warning("Cannot mix %s without FFmpeg; leaving it out" % fileDictionary['Name'])
+                continue
+        mixable.append({'Name': fileDictionary['Name'], 'LoopPoint': fileDictionary['LoopPoint'], 'Gain': fileDictionary.get('Gain', 0)})
+    return(mixable)
+
+@profiled("mix")
+def mixVoicesBlock(voices, start, length):
+    # Adds together 'length' samples of every voice, beginning 'start' samples into
+    # the mix, and returns them as a float32 array of shape (length, CHANNELS).
+    # Like amovie=...:loop=0:seek_point=..., each voice plays from its loop point to
+    # its end and then returns to its loop point, forever. Because of this, any
+    # block of the mix can be calculated without calculating the ones before it.
+    # Each voice is multiplied by its Gain, if it has one. Whatever their sample
+    # type, voices are added up in the units of 16-bit samples (see pcm16Units).
+    accumulator = numpy.zeros((length, CHANNELS), dtype=numpy.float32)
+    for voice in voices:
+        frames = voice['Frames']
+        loopStart = voice['LoopStart']
+        loopLength = len(frames) - loopStart
+        offset = voice.get('Offset', 0)
+        gain = numpy.float32(10 ** (voice.get('Gain', 0) / 20) * voice.get('Factor', 1))
+        position = start % loopLength
+        done = 0
+        while done < length:
+            take = min(length - done, loopLength - position)
+            section = frames[loopStart+position:loopStart+position+take]
+            if offset:
+                section = section.astype(numpy.float32) - offset
+            if gain == 1:
+                accumulator[done:done+take] += section
+            else:
+                accumulator[done:done+take] += section * gain
+            done += take
+            position = 0
+    return(accumulator)
+
+# Files already mapped by this (worker) process, so each block doesn't open them again
+mixWorkerWavs = dict()
+mixWorkerStores = dict()
+# The voices of the one shard of a mix that this worker process mixes (see mixBlocks)
+mixWorkerShard = list()
+
+def workerMixVoices(directory, fileDictionaryList, useStore=False):
+    # Runs in a worker process: opens files for mixing (see openMixVoices), from the
+    # directory's sample store if useStore is True. Every worker maps the same
+    # sample store, so they share its pages in memory.
+    store = None
+    if useStore:
+        if directory not in mixWorkerStores:
+            mixWorkerStores[directory] = openSampleStore(directory)
+        store = mixWorkerStores[directory]
+    return(openMixVoices(directory, fileDictionaryList, cache=mixWorkerWavs, store=store))
+
+def openMixShard(directory, shard, useStore=False):
+    # Runs once in each worker process of mixBlocks, as it starts: maps the files of
+    # its own shard of the mix, and no others, raising its open file limit to suit
+    mixWorkerShard[:] = workerMixVoices(directory, shard, useStore)
+
+def mixShardBlock(start, length):
+    # Runs in a worker process: adds together one block of this process's shard of a mix.
+    # The result is not scaled, so that adding the shards together gives exactly the
+    # same headroom as mixing every file at once.
+    return(mixVoicesBlock(mixWorkerShard, start, length))
+
+def mixBlocks(directory, voices, totalSamples, workers=1, useStore=False):
+    # Yields the unscaled sum of all voices, MIXBLOCK samples at a time.
+    # With one worker, voices are as openMixVoices returns them. With more, they
+    # are as mixableFiles returns them, and are split into one shard per worker
+    # process, each of which maps only the files of its own shard, for as long as
+    # the mix lasts; every process mixes its shard of the same block, and the
+    # partial mixes are added together here. Workers keep up to MIXAHEAD blocks
+    # ahead of us.
+    starts = range(0, totalSamples, MIXBLOCK)
+    if workers <= 1:
+        for start in starts:
+            yield(mixVoicesBlock(voices, start, min(MIXBLOCK, totalSamples - start)))
+        return
+    executors = [concurrent.futures.ProcessPoolExecutor(max_workers=1, initializer=openMixShard, initargs=(directory, voices[i::workers], useStore))
+                 for i in range(min(workers, len(voices)))]
+    pending = collections.deque()
+    nextStart = iter(starts)
+    def submitNext():
+        start = next(nextStart, None)
+        if start is not None:
+            length = min(MIXBLOCK, totalSamples - start)
+            pending.append([executor.submit(mixShardBlock, start, length) for executor in executors])
+    try:
+        for i in range(MIXAHEAD + 1):
+            submitNext()
+        while pending:
+            futures = pending.popleft()
+            submitNext()
+            # Always add the shards in the same order, so the result doesn't
+            # depend on which worker finishes first
+            block = futures[0].result()
+            for future in futures[1:]:
+                block += future.result()
+            yield(block)
+    finally:
+        for futures in pending:
+            for future in futures:
+                future.cancel()
+        for executor in executors:
+            executor.shutdown()
+
+def mixFilesNative(directory, fileDictionaryList, renderDuration, outputFile, workers=1, store=None):
+    # Mixes the files in fileDictionaryList (as chosen by mixDirectoryFiles) without
+    # amix, so there is no limit to the number of inputs. The files are memory-mapped
+    # and summed a block at a time into a float32 accumulator, so memory use doesn't
+    # grow with the length of the mix. With more than one worker, the files are
+    # shared between several processes (see mixBlocks). FFmpeg then applies MIXPOST
+    # to the result, arriving through a pipe, and writes the output file.
+    # Files are read from the sample store, if one is given (see openSampleStore).
+    command = ffmpegCommand("-y", "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+                            "-af", MIXPOST, "-ac", str(CHANNELS), "-acodec", "pcm_s16le", outputFile)
+    logging.debug("FFmpeg command is: %s" % command)
+    runFFmpeg(command, mixStream(directory, fileDictionaryList, renderDuration, workers, store)).check_returncode()
+    return(outputFile)
+
+def mixStream(directory, fileDictionaryList, renderDuration, workers=1, store=None):
+    # The mix of the files in fileDictionaryList, before MIXPOST, as blocks of
+    # float32 samples (f32le, full scale 1.0) at SAMPLERATE with CHANNELS channels,
+    # ready to be piped to FFmpeg.
+    # Nothing is opened until the first block is asked for, so that many mixes can
+    # wait their turn (see encodeMixes) without holding their files open, and
+    # everything is let go of once the last has been taken.
+    # With more than one worker, the files are mapped by the workers alone.
+    if workers > 1:
+        voices = mixableFiles(directory, fileDictionaryList, store)
+    else:
+        voices = openMixVoices(directory, fileDictionaryList, store=store)
+    if not voices:
+        raise ValueError("None of the files in %s can be mixed" % directory)
+    # amix divides its output by the number of inputs, and so do we. Also
+    # scale the 16-bit units that voices are added up in (see mixVoicesBlock)
+    # to FFmpeg's floating-point range.
+    scale = 1 / (len(voices) * 32768)
+    for block in mixBlocks(directory, voices, int(renderDuration * SAMPLERATE), workers, store is not None):
+        block *= scale
+        yield(block.tobytes())
+
+def mixSegment(directory, fileDictionaryList, start, length, preroll, postroll, postFilter, segmentFile, useStore=False):
+    # Runs in a worker process: mixes 'length' samples of a mix, beginning 'start'
+    # samples into it, and puts them through postFilter (MIXPOST) between the 'preroll'
+    # samples before them and the 'postroll' samples after them, which are then
+    # thrown away. The result is written to segmentFile as float32 samples, with
+    # full scale 1.0.
+    voices = workerMixVoices(directory, fileDictionaryList, useStore)
+    scale = 1 / (len(voices) * 32768)
+    command = ffmpegCommand("-y", "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+                            "-af", postFilter + ",atrim=start_sample=%d:end_sample=%d" % (preroll, preroll + length),
+                            "-ac", str(CHANNELS), "-f", "f32le", segmentFile)
+    end = start + length + postroll
+    def mixed():
+        for blockStart in range(start - preroll, end, MIXBLOCK):
+            block = mixVoicesBlock(voices, blockStart, min(MIXBLOCK, end - blockStart))
+            block *= scale
+            yield(block.tobytes())
+    runFFmpeg(command, mixed()).check_returncode()
+    return(segmentFile)
+
+def mixFilesSegmented(directory, fileDictionaryList, renderDuration, outputFile, workers=1, store=None):
+    # Mixes the files in fileDictionaryList like mixFilesNative, but rather than
+    # sharing every block of the mix between the workers, gives each worker whole
+    # segments of it, MIXSEGMENT seconds long, to mix and put through MIXPOST by itself,
+    # so that MIXPOST runs in parallel as well. Where each voice is at any moment
+    # depends only on its loop point, so every segment is exactly the mix that
+    # mixFilesNative makes; only MIXPOST's filters, which adapt to what came before,
+    # can differ. So each segment starts MIXPREROLL seconds early, to let them
+    # settle, and ends as long after, for those that look ahead, and overlaps the
+    # next by MIXCROSSFADE seconds, over which one fades into the other, so that
+    # no seam can be heard.
+    # Only the workers map the files, so they don't inherit any from us.
+    voices = mixableFiles(directory, fileDictionaryList, store)
+    if not voices:
+        raise ValueError("None of the files in %s can be mixed" % directory)
+    totalSamples = int(renderDuration * SAMPLERATE)
+    segment = int(MIXSEGMENT * SAMPLERATE)
+    crossfade = min(int(MIXCROSSFADE * SAMPLERATE), segment)
+    # Both segments are the same mix, so a straight line keeps the level steady
+    ramp = ((numpy.arange(crossfade, dtype=numpy.float32) + 0.5) / crossfade)[:, None]
+    starts = range(0, totalSamples, segment)
+    roll = int(MIXPREROLL * SAMPLERATE)
+    segmentFiles = ["%s/%s-%d.f32" % (temporaryLocation(), os.path.basename(outputFile), i) for i in range(len(starts))]
+
+    command = ffmpegCommand("-y", "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+                            "-ac", str(CHANNELS), "-acodec", "pcm_s16le", outputFile)
+    logging.debug("Mixing %d segments of %s with %d processes" % (len(starts), outputFile, workers))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(mixSegment, directory, voices, start, min(segment + crossfade, totalSamples - start),
+                                   min(roll, start), min(roll, max(totalSamples - start - segment - crossfade, 0)),
+                                   MIXPOST, segmentFile, store is not None)
+                   for start, segmentFile in zip(starts, segmentFiles)]
+        def stitched():
+            # The segments in order, each faded into from the overlap at the end of the one before
+            tail = None
+            for i, future in enumerate(futures):
+                frames = numpy.fromfile(future.result(), dtype="<f4").reshape(-1, CHANNELS)
+                os.remove(segmentFiles[i])
+                if tail is not None:
+                    overlap = min(len(tail), len(frames))
+                    frames[:overlap] = tail[:overlap] * (1 - ramp[:overlap]) + frames[:overlap] * ramp[:overlap]
+                if i < len(futures) - 1:
+                    tail = frames[segment:]
+                    frames = frames[:segment]
+                yield(frames.tobytes())
+        try:
+            runFFmpeg(command, stitched()).check_returncode()
+        finally:
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            for segmentFile in segmentFiles:
+                if os.path.exists(segmentFile):
+                    os.remove(segmentFile)
+    return(outputFile)
+
+def chooseMix(directory, count=999999, renderDuration=3600, mixNumber=0, seed=None, avoidSilence=False, loudness=None):
+    # Chooses the files for a mix (see mixDirectoryFiles), and where each loops,
+    # and names the mix. Returns the name of the mix's file, and a list of
+    # dictionaries, one for each file, with keys Name, Duration, LoopPoint and
+    # (if a loudness is given) Gain.
 
-def mixDirectoryFiles(directory, count=999999, renderDuration=3600):
-    # Mixes all the audio files in a single cirectory into one file
-    # Count determines how many files get mixed,
-    # Duration is the duration of the output mix
-    
     # Start with a list of all the audio files we're interested in
-    fileList = filterAudioFiles(os.listdir(directory))
+    # (sorted, so that the choice of files doesn't depend on the order the system lists them in)
+    fileList = sorted(listAudioFiles(directory))
 
     # Never request more files to mix than there are files available
     number = len(fileList)
     if count > number:
         count = number
 
-    outputFile = directory + "/" + "MIX-" + str(count) + "-" + str(renderDuration) + "-" + "".join(random.choices(string.ascii_uppercase + string.digits, k=9)) + '.wav'
+    # The same files, count, duration and mixNumber always give the same mix (see SEED),
+    # so mixes of the same size differ only if their mixNumber does. A seed may be
+    # given instead of the run's.
+    rng = randomStream("mix", "%s %s %s" % (count, renderDuration, mixNumber), seed)
+    outputFile = directory + "/" + "MIX-" + str(count) + "-" + str(renderDuration) + "-" + "".join(rng.choice(list(string.ascii_uppercase + string.digits), 9)) + '.wav'
+    # The same mix made again must not mix in the one it is replacing
+    if os.path.basename(outputFile) in fileList:
+        fileList.remove(os.path.basename(outputFile))
+        number = len(fileList)
+        count = min(count, number)
 
     # Create a list of dictionaries.
     # Each dictionary corresponds to a file.
@@ -440,25 +2658,77 @@ def mixDirectoryFiles(directory, count=999999, renderDuration=3600):
     logging.debug("We have %d files." % count)
     fileDictionaryList = list()
     # Only mix as many files as we're instructed to
-    for item in random.sample(fileList, count):
+    selection = [fileList[i] for i in rng.choice(number, count, replace=False)]
+    metadata = clipMetadata([directory + "/" + item for item in selection])
+    analysis = dict()
+    if avoidSilence or loudness is not None:
+        analysis = fileAnalysis([directory + "/" + item for item in selection])
+    for item in selection:
         fileDictionary = dict()
         fileDictionary['Name'] = item
-        duration = clipLength(directory + "/" + item)
+        duration = int(metadata[directory + "/" + item]['Duration'])
         fileDictionary['Duration'] = duration
-        loopPoint = random.randint(0, duration-1)
+        loudList = loudSeconds(analysis[directory + "/" + item], duration) if avoidSilence else []
+        if loudList:
+            loopPoint = loudList[int(rng.integers(0, len(loudList)))]
+        else:
+            loopPoint = int(rng.integers(0, duration))
         fileDictionary['LoopPoint'] = loopPoint
+        if loudness is not None:
+            fileDictionary['Gain'] = matchingGain(analysis[directory + "/" + item], loudness)
         fileDictionaryList.append(fileDictionary)
+    return(outputFile, fileDictionaryList)
+
+def mixDirectoryFiles(directory, count=999999, renderDuration=3600, engine="ffmpeg", workers=1, mixNumber=0, seed=None, store=False,
+                      avoidSilence=False, loudness=None, segmented=False):
+    # Mixes all the audio files in a single cirectory into one file
+    # Count determines how many files get mixed,
+    # Duration is the duration of the output mix
+    # Engine is "ffmpeg" to mix with FFmpeg's amix filter, or "numpy" to add the
+    # files together in Python (which is the only way to mix more than AMIXLIMIT files)
+    # If store is True, the files are read from the directory's sample store (see
+    # buildSampleStore), when it has one (numpy engine only).
+    # Workers is the number of processes that share the mixing (numpy engine only);
+    # None means one per processor core.
+    # If avoidSilence is True, no file's loop point is put where it is silent, and if
+    # a loudness is given (in dB, as analyseSamples measures it), every file is brought
+    # to that loudness. Both use the files' analysis (see analyseDirectory).
+    # The files are chosen by chooseMix.
+    # If segmented is True, the workers make whole segments of the mix each (see
+    # mixFilesSegmented), which is much quicker for long mixes (numpy engine only).
+    outputFile, fileDictionaryList = chooseMix(directory, count, renderDuration, mixNumber, seed, avoidSilence, loudness)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if engine == "ffmpeg" and len(fileDictionaryList) > AMIXLIMIT:
+        logging.warning("amix cannot mix %d files; mixing them without FFmpeg instead" % len(fileDictionaryList))
+        engine = "numpy"
+    if engine == "ffmpeg" and (workers > 1 or segmented):
+        logging.info("Mixing with %d processes, without FFmpeg's amix" % workers)
+        engine = "numpy"
+    sampleStore = None
+    if store:
+        sampleStore = openSampleStore(directory)
+        if sampleStore is None:
+            logging.warning("%s has no sample store for mixing at %d Hz with %d channels" % (directory, SAMPLERATE, CHANNELS))
+        elif engine == "ffmpeg":
+            logging.info("Mixing without FFmpeg's amix, to read from the sample store")
+            engine = "numpy"
+    if engine == "numpy" and segmented:
+        return(mixFilesSegmented(directory, fileDictionaryList, renderDuration, outputFile, workers, sampleStore))
+    if engine == "numpy":
+        return(mixFilesNative(directory, fileDictionaryList, renderDuration, outputFile, workers, sampleStore))
 
     # Start to build FFmpeg command
     
-    command = '"' + FFMPEG + 'ffmpeg" -f lavfi -i "anullsrc" -filter_complex_script "'
-
     script = ''
 
     # Write the filter for all the input files
     for i, fileDictionary in enumerate(fileDictionaryList):
         script += "amovie='" + ffmpegEscape(directory + "/" + fileDictionary['Name']) + "'"
         script += ":loop=0:seek_point=" + str(fileDictionary['LoopPoint'])
+        if fileDictionary.get('Gain'):
+            script += ",volume=%.2fdB" % fileDictionary['Gain']
         script += "[" + str(i) + "];"
 
     # Now merge the input files together
@@ -467,98 +2737,537 @@ def mixDirectoryFiles(directory, count=999999, renderDuration=3600):
     # The end of the command resets the timestamps because we are looping over
     # incoming audio and, therefore, losing the original timestamps which
     # harms FFmpeg's ability to time its own output.
-    script += "amix=inputs=" + str(i+1) + ",asetpts=N/SR/TB,volume=-20dB,bass=f=400:g=-5,treble=f=200:g=15,treble=f=1800:g=10,dynaudnorm,bs2b[out0]"
-
-    # Now write the script to a temporary file
-    tempHandle = tempfile.NamedTemporaryFile(delete=False)
-    name = tempHandle.name
-    logging.debug("Temp file is: %s" % name)
-    tempHandle.write(script.encode('utf-8'))
-    tempHandle.close()
+    script += "amix=inputs=" + str(i+1) + ",asetpts=N/SR/TB," + MIXPOST + "[out0]"
 
-    command += name + '" -map "[out0]" -ac ' + str(CHANNELS) + ' -t ' + str(renderDuration) + ' -acodec pcm_s16le "' + outputFile + '"'
-
-    print(command)
-    subprocess.run(command)
+    # The script, which may be very long, goes to FFmpeg through its standard input
+    command = ffmpegCommand("-y", "-f", "lavfi", "-i", "anullsrc", "-filter_complex_script", "pipe:0", "-map", "[out0]",
+                            "-ac", str(CHANNELS), "-t", str(renderDuration), "-acodec", "pcm_s16le", outputFile)
+    logging.debug("FFmpeg command is: %s" % command)
+    runFFmpeg(command, script).check_returncode()
+    return(outputFile)
+
+def openStreamOutput(output):
+    # Returns a function that writes bytes to the stream's output, which may be
+    # "-" for standard output (to pipe into FFmpeg or an Icecast source client),
+    # "tcp:HOST:PORT" to serve the stream to whoever connects there, or the name of
+    # a file or named pipe. The writing function returns False once nobody can
+    # ever read the stream again.
+    # Listeners over TCP are never waited for: what one hasn't taken yet is kept for
+    # it, and one that falls more than STREAMBACKLOG seconds behind is dropped.
+    if output == "-":
+        handle = sys.stdout.buffer
+    elif output.startswith("tcp:"):
+        host, port = output[4:].rsplit(":", 1)
+        server = socket.create_server((host, int(port)))
+        clients = list()
+        backlog = STREAMBACKLOG * SAMPLERATE * CHANNELS * 2
+        def accept():
+            while True:
+                client, address = server.accept()
+                logging.info("Streaming to %s:%s" % address[0:2])
+                client.setblocking(False)
+                clients.append({'Socket': client, 'Address': address, 'Pending': b""})
+        threading.Thread(target=accept, daemon=True).start()
+        def sendToClients(data):
+            # Listeners come and go; while there are none, the audio goes nowhere
+            for client in list(clients):
+                client['Pending'] += data
+                try:
+                    sent = client['Socket'].send(client['Pending'])
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    sent = None
+                if sent is not None:
+                    client['Pending'] = client['Pending'][sent:]
+                    if len(client['Pending']) <= backlog:
+                        continue
+                    logging.warning("Dropping %s:%s, which has fallen behind the stream" % client['Address'][0:2])
+                clients.remove(client)
+                client['Socket'].close()
+            return(True)
+        return(sendToClients)
+    else:
+        handle = open(output, "wb")
+    def writeToHandle(data):
+        try:
+            handle.write(data)
+            handle.flush()
+        except (BrokenPipeError, ValueError):
+            return(False)
+        return(True)
+    return(writeToHandle)
+
+def startStreamVoice(directory, fileList, wavCache, rng, age=0):
+    # Chooses a file for a new voice in the stream, and where in it to begin.
+    # A voice plays from there, looping like a voice in a mix, for a random
+    # lifetime, fading in at the beginning and out at the end. age is how far through
+    # its lifetime it is already (so that voices at the start don't all change together).
+    # The choices are made with the random number generator rng.
+    # Returns None if the chosen file can't be played.
+    fileName = fileList[rng.integers(0, len(fileList))]
+    if fileName not in wavCache:
+        wavCache[fileName] = readWav(directory + "/" + fileName)
+    wavCache.move_to_end(fileName)
+    wav = wavCache[fileName]
+    if wav is None or wav['SampleRate'] != SAMPLERATE or wav['Channels'] != CHANNELS or wav['Samples'] == 0:
+        return(None)
+    life = int(rng.uniform(STREAMVOICELIFE[0], STREAMVOICELIFE[1]) * SAMPLERATE)
+    age = int(age * life)
+    loopStart = int(rng.integers(0, wav['Samples']))
+    offset, factor = pcm16Units(wav['Frames'].dtype)
+    return({'Name': fileName, 'Frames': wav['Frames'], 'LoopStart': loopStart, 'Life': life, 'Played': age,
+            'Offset': offset, 'Factor': factor})
+
+def streamVoiceBlock(voice, length):
+    # The next 'length' samples of a voice, with its fades, as float32 in the units
+    # of 16-bit samples (see pcm16Units); moves the voice on by that much
+    frames = voice['Frames']
+    loopLength = len(frames) - voice['LoopStart']
+    block = numpy.zeros((length, CHANNELS), dtype=numpy.float32)
+    playing = min(length, voice['Life'] - voice['Played'])
+    position = voice['Played'] % loopLength
+    done = 0
+    while done < playing:
+        take = min(playing - done, loopLength - position)
+        block[done:done+take] = frames[voice['LoopStart']+position:voice['LoopStart']+position+take]
+        done += take
+        position = 0
+    if voice['Offset'] or voice['Factor'] != 1:
+        block[:done] -= voice['Offset']
+        block[:done] *= voice['Factor']
+    # Fade in at the beginning of the voice's life, and out at the end
+    fade = max(1, min(int(FADE * SAMPLERATE), voice['Life'] // 2))
+    played = numpy.arange(voice['Played'], voice['Played'] + length)
+    gain = numpy.clip(numpy.minimum(played, voice['Life'] - played) / fade, 0, 1)
+    voice['Played'] += length
+    return(block * gain[:, None].astype(numpy.float32))
+
+def streamDirectory(directory, voices=64, output="-", rescan=10, duration=None, realtime=True):
+    # Plays a never-ending soundscape from the files in a directory (such as
+    # VOLUMEPROCESSED), instead of rendering a mix of fixed length.
+    # A pool of 'voices' voices is kept playing; when one comes to the end of its life,
+    # another file takes its place. The directory is looked at again every 'rescan'
+    # seconds, so new files (from new visitors, say) join the pool as they arrive.
+    # The stream is raw 16-bit little-endian PCM at SAMPLERATE with CHANNELS channels,
+    # written to 'output' (see openStreamOutput), so that, for example,
+    #     ffmpeg -f s16le -ar 48000 -ac 2 -i tcp://localhost:8000 ...
+    # can encode or broadcast it. It runs at real speed (unless realtime is False)
+    # for 'duration' seconds, or forever. Only a bounded number of files are kept
+    # open, and nothing accumulates, so memory and processor use stay flat.
+    write = openStreamOutput(output)
+    # With the same seed and the same files, the stream is the same
+    rng = randomStream("stream", os.path.basename(os.path.normpath(directory)))
+    blockLength = int(STREAMBLOCK * SAMPLERATE)
+    # Keep a few more files mapped than there are voices, forgetting the least recently used
+    wavCache = collections.OrderedDict()
+    fileList = list()
+    lastScan = None
+    pool = list()
+    # Each voice is a share of the whole, as in a mix, and is in 16-bit units
+    scale = 1 / (voices * 32768)
+    startTime = time.monotonic()
+    blocks = 0
+    while duration is None or blocks * blockLength < duration * SAMPLERATE:
+        if lastScan is None or time.monotonic() - lastScan > rescan:
+            newList = sorted(listAudioFiles(directory))
+            if len(newList) != len(fileList):
+                logging.info("%d files to choose from" % len(newList))
+            fileList = newList
+            lastScan = time.monotonic()
+        # Replace voices whose lives are over
+        pool = [voice for voice in pool if voice['Played'] < voice['Life']]
+        attempts = 0
+        while fileList and len(pool) < voices and attempts < voices * 2:
+            voice = startStreamVoice(directory, fileList, wavCache, rng, age=rng.random() if blocks == 0 else 0)
+            if voice is not None:
+                pool.append(voice)
+            attempts += 1
+        while len(wavCache) > voices * 2:
+            wavCache.popitem(last=False)
+
+        block = numpy.zeros((blockLength, CHANNELS), dtype=numpy.float32)
+        for voice in pool:
+            block += streamVoiceBlock(voice, blockLength)
+        block *= scale
+        if not write(floatToPcm16(block)):
+            logging.info("Nobody is listening any more")
+            break
+        blocks += 1
+        if realtime:
+            # Never get more than one block ahead of the clock
+            delay = startTime + blocks * STREAMBLOCK - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
     return()
 
-def interweaveFilesCommand(file1, file2, sliceDuration=20, crossfade=8):
-    # Produces an FFmpeg command that interweaves two files using the 'acrossfade' effect
-    # Both files must be approximately the same length.
-    # Behaviour under other circumstances is presently undefined.
-    
-    length1 = clipLength(file1) / 2
-    length2 = clipLength(file2) / 2
-    FFmpegCommand = '"' + FFMPEG + '/' + 'ffmpeg" '
-    startTime = 0
-    inputIndex = 0
-    
-    while (startTime <= length1) and (startTime <= length2):
-        FFmpegCommand += '-ss ' + str(startTime) + ' -t ' + str(sliceDuration) + ' '
-        FFmpegCommand += '-i "' + file1 + '" '
-        FFmpegCommand += '-ss ' + str(startTime) + ' -t ' + str(sliceDuration) + ' '
-        FFmpegCommand += '-i "' + file2 + '" '
-        startTime += sliceDuration
-        # Number of files entered so far
-        inputIndex += 2
-
-    FFmpegCommand += '-filter_complex "'
-    # In the command line, outputIndex will be prefixed with 'op' so that
-    # it is distinct from any input indices
-    #outputIndex = 0
-    #for i in range(0, inputIndex):
-    #    FFmpegCommand += '[' + str(i) + ']asetpts=N/SR/TB[' + 'c' + str(i) + '];'
-    
-    outputIndex = 0
-    for i in range(0, inputIndex, 2):
-        FFmpegCommand += '[' + str(i) + ']' + '[' + str(i+1) + ']'
-        FFmpegCommand += 'acrossfade=d=' + str(crossfade) 
-        FFmpegCommand += '[' + 'op' + str(outputIndex) + ']' + ';'
-        outputIndex += 1
-
-    for op in range(0, outputIndex):
-        FFmpegCommand += '[' + 'op' + str(op) + ']'
-        
-    FFmpegCommand += 'concat=n=' + str(op+1) + ':v=0:a=1"'
-
-    return(FFmpegCommand)
-
-
-
-
-# TESTING OR YOUR MAIN COMMANDS BEGIN HERE
-
-# This command creates mono files out of all files in the directory given
-# at a standard volume level.
-#standardiseDirectory("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/")
-
-# This command creates repitched versions of all files in a particular directory
-# creating eight (default, can be changed in the call) variants
-#pitchShiftDirectory("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED", variants=16)
-
-# This returns a list of lists, consisting of multi-channel volume control points
-# for each file discovered. These lists can be used to control FFmpeg in the next step
-#renderList = makeVolumeAndTimeNodeList("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED")
-
-# This command takes the list of lists consisting of multi-channel volume control points,
-# and then executes FFmpeg with those parameters to create multi-channel files of each sound,
-# ready for playback on multi-channel systems, or for further mixing.
-#result = repitchRenderList(renderList)
-
-# This example command remixes random selections from sets of files in the given directory,
-# between a low and high number. The example you see mixes betweeen 161 and 559 files into
-# multi-channel files for playback.
-#for mixNumber in range(36, 80):
-#    result = mixDirectoryFiles("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED", count=mixNumber)
-#pprint.pprint(result)
-
-# This command, in development, interweaves two files. It is not yet finished.
-#print(interweaveFilesCommand("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/MIX-64-3600-H3YSXY6XN.wav", \
-                            #"E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/MIX-4-3600-CW6UGJWVW.wav"))
-
-
-# This command, using parallel processes, converts uncompressed files ready for compressed distribtion
-result = multipleConvert("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/mixed/recursive/")
+def openQueue(queueFile):
+    # Opens (making it if need be) a queue of jobs kept in an SQLite file.
+    # The file may be on storage shared between machines, as long as its file
+    # locking works (SMB, or NFS with locking: SQLite's own locking is used to
+    # make sure only one worker takes each job).
+    connection = sqlite3.connect(queueFile, timeout=120, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, batch TEXT, name TEXT, job TEXT, "
+                       "state TEXT, worker TEXT, lease REAL, attempts INTEGER, result TEXT)")
+    connection.execute("CREATE INDEX IF NOT EXISTS jobState ON jobs (state, id)")
+    return(connection)
+
+def queueJobs(queueFile, jobList):
+    # Adds jobs to a queue for workers (see runWorker) to do, and returns the name of the
+    # batch they belong to. Each job is a dictionary, which must be plain enough data to be
+    # saved as JSON, with keys:
+    # Name      unique name of the job
+    # Kind      "render" or "mix"
+    # and for renders, File, Duration, Times, Volumes and Engine (see repitchRenderList),
+    # or for mixes, Directory, Count, RenderDuration, MixNumber, Seed, Engine and Workers
+    # (see mixDirectoryFiles). Files are named as they are on every machine.
+    batch = "%s:%d:%s" % (socket.gethostname(), os.getpid(), os.urandom(4).hex())
+    connection = openQueue(queueFile)
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.executemany("INSERT INTO jobs (batch, name, job, state, attempts) VALUES (?, ?, ?, 'waiting', 0)",
+                               [(batch, job['Name'], json.dumps(job)) for job in jobList])
+    connection.close()
+    logging.info("Queued %d jobs as batch %s" % (len(jobList), batch))
+    return(batch)
+
+def waitForQueuedJobs(queueFile, batch, progress=None, poll=1):
+    # Waits for the workers to finish every job in a batch, and returns their results
+    # (see runJob, with the key Worker added) in the order the jobs were queued,
+    # giving each to the progress function as it arrives. The batch is then taken
+    # off the queue.
+    connection = openQueue(queueFile)
+    total = connection.execute("SELECT COUNT(*) FROM jobs WHERE batch = ?", (batch,)).fetchone()[0]
+    results = dict()
+    lastLog = time.monotonic()
+    while len(results) < total:
+        for jobId, state, result in connection.execute("SELECT id, state, result FROM jobs WHERE batch = ? AND state IN ('done', 'failed')",
+                                                       (batch,)).fetchall():
+            if jobId in results:
+                continue
+            results[jobId] = json.loads(result)
+            if state == "done":
+                logging.info("%s finished on %s in %.2f seconds" % (results[jobId]['Name'], results[jobId]['Worker'], results[jobId]['Time']))
+            else:
+                logging.error("%s failed on %s (return code %s):\n%s" % (results[jobId]['Name'], results[jobId]['Worker'],
+                                                                        results[jobId]['ReturnCode'], results[jobId]['Stderr']))
+            if progress is not None:
+                progress(results[jobId])
+        if len(results) < total:
+            if time.monotonic() - lastLog > 60:
+                logging.info("%d of %d queued jobs done" % (len(results), total))
+                lastLog = time.monotonic()
+            time.sleep(poll)
+    with connection:
+        connection.execute("DELETE FROM jobs WHERE batch = ?", (batch,))
+    connection.close()
+    return([results[jobId] for jobId in sorted(results)])
+
+def runQueuedJobs(queueFile, jobList, progress=None):
+    # Queues jobs (see queueJobs) and waits for the workers to do them (see waitForQueuedJobs)
+    if not jobList:
+        return([])
+    return(waitForQueuedJobs(queueFile, queueJobs(queueFile, jobList), progress))
+
+def renderQueuedFile(render, engine):
+    # Renders a file for a worker, with renderEnvelope() if engine is "numpy"
+    # and it can, or with FFmpeg
+    if engine == "numpy":
+        outputFile = renderEnvelope(render)
+        if outputFile is not None:
+            return(outputFile)
+    completed = runFFmpeg(*fullFFmpegCommand(render['Name'], makeFFmpegVolumeCommands(render)))
+    if completed.returncode != 0:
+        raise RuntimeError("FFmpeg failed (return code %d):\n%s" % (completed.returncode, completed.stderr.decode("utf-8", "replace")[-4000:]))
+    return(os.path.dirname(render['Name']) + "/VOLUMEPROCESSED/" + os.path.basename(render['Name']))
+
+def queuedJobFunction(job):
+    # The function that does a job taken from a queue
+    if job['Kind'] == "render":
+        render = {'Name': job['File'], 'Duration': job['Duration'], 'Times': job['Times'], 'Volumes': job['Volumes']}
+        render.update({key: job[key] for key in ('Speakers', 'Levels', 'Azimuths') if key in job})
+        return(lambda: renderQueuedFile(render, job['Engine']))
+    if job['Kind'] == "mix":
+        return(lambda: mixDirectoryFiles(job['Directory'], job['Count'], job['RenderDuration'], job['Engine'], job['Workers'],
+                                         job['MixNumber'], job['Seed'], job.get('Store', False), job.get('AvoidSilence', False),
+                                         job.get('Loudness'), job.get('Segmented', False)))
+    raise ValueError("Unknown kind of job: %s" % job['Kind'])
+
+def claimQueuedJob(connection, worker):
+    # Takes the next waiting job from the queue for a worker, and returns (id, job),
+    # or None if there are none waiting. Jobs whose workers have not been heard from
+    # for QUEUELEASE seconds are given to someone else, unless they have already
+    # been tried too often (perhaps because they kill the workers that take them).
+    now = time.time()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        for jobId, name, attempts in connection.execute("SELECT id, name, attempts FROM jobs WHERE state = 'running' AND lease < ?", (now,)).fetchall():
+            if attempts > RETRIES:
+                result = {'Name': name, 'Stage': None, 'Command': None, 'ReturnCode': None, 'Stderr': "The workers that took this job stopped",
+                          'Output': None, 'Attempts': attempts, 'Time': 0, 'Worker': worker}
+                connection.execute("UPDATE jobs SET state = 'failed', result = ? WHERE id = ?", (json.dumps(result), jobId))
+            else:
+                logging.warning("Nothing heard about %s; giving it to another worker" % name)
+                connection.execute("UPDATE jobs SET state = 'waiting', worker = NULL WHERE id = ?", (jobId,))
+        row = connection.execute("SELECT id, job FROM jobs WHERE state = 'waiting' ORDER BY id LIMIT 1").fetchone()
+        if row is not None:
+            connection.execute("UPDATE jobs SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1 WHERE id = ?",
+                               (worker, now + QUEUELEASE, row[0]))
+        connection.execute("COMMIT")
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    if row is None:
+        return(None)
+    return(row[0], json.loads(row[1]))
+
+def runWorker(queueFile, threads=1, idle=None, poll=1):
+    # Does jobs from a queue (see queueJobs) until there have been none for 'idle'
+    # seconds, or forever if idle is None. Run as many workers as you like, on as
+    # many machines as can see the queue file and the audio files (under the same
+    # names), with
+    #     python Chorus.py --worker QUEUEFILE
+    # Each worker does 'threads' jobs at once. While it works on them, it renews
+    # its claim on them every few seconds, so that if it stops, they are given to
+    # other workers. (The machines' clocks should agree to within a few seconds.)
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    logging.info("Worker %s taking jobs from %s" % (worker, queueFile))
+    openQueue(queueFile).close()
+    finished = threading.Event()
+
+    def renewLeases():
+        connection = openQueue(queueFile)
+        while not finished.wait(QUEUELEASE / 4):
+            with connection:
+                connection.execute("UPDATE jobs SET lease = ? WHERE state = 'running' AND worker = ?", (time.time() + QUEUELEASE, worker))
+        connection.close()
+
+    def work():
+        connection = openQueue(queueFile)
+        lastJob = time.monotonic()
+        done = 0
+        while idle is None or time.monotonic() - lastJob < idle:
+            claimed = claimQueuedJob(connection, worker)
+            if claimed is None:
+                time.sleep(poll)
+                continue
+            jobId, job = claimed
+            result = runJob({'Name': job['Name'], 'Stage': job.get('Kind'), 'Function': lambda: queuedJobFunction(job)()}, RETRIES)
+            result['Worker'] = worker
+            with connection:
+                # If the job was given to someone else meanwhile, their result will do
+                connection.execute("UPDATE jobs SET state = ?, result = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                                   ("done" if result['ReturnCode'] == 0 else "failed", json.dumps(result), jobId, worker))
+            done += 1
+            lastJob = time.monotonic()
+        connection.close()
+        return(done)
+
+    renewer = threading.Thread(target=renewLeases, daemon=True)
+    renewer.start()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        done = sum(executor.map(lambda thread: work(), range(threads)))
+    finished.set()
+    logging.info("Worker %s did %d jobs" % (worker, done))
+    return(done)
+
+def queueMixes(queueFile, directory, countList, renderDuration=3600, engine="numpy", workers=1, store=False,
+               avoidSilence=False, loudness=None, segmented=False):
+    # Has the workers taking jobs from a queue (see runWorker) make a mix of each
+    # number of files in countList (see mixDirectoryFiles), and returns the names of
+    # the files they made. The mixes are the ones this machine would make itself,
+    # with the same seed.
+    results = runQueuedJobs(queueFile, [{'Name': "mix %d (%d files)" % (i, count), 'Kind': "mix", 'Directory': directory, 'Count': count,
+                                         'RenderDuration': renderDuration, 'MixNumber': countList[:i].count(count), 'Seed': currentSeed(),
+                                         'Engine': engine, 'Workers': workers, 'Store': store, 'AvoidSilence': avoidSilence,
+                                         'Loudness': loudness, 'Segmented': segmented} for i, count in enumerate(countList)])
+    return([result['Output'] for result in results])
+
+def interweaveSource(filename):
+    # Opens a file for interweaveFiles. A WAV file at SAMPLERATE with CHANNELS channels
+    # is mapped into memory, so that only the parts that are heard are ever read;
+    # anything else is decoded to those by FFmpeg, which sends it through a pipe.
+    # Returns a dictionary with keys Name, Samples and either Frames or Process
+    # and Errors (a temporary file of what FFmpeg has to say, kept there rather than
+    # in a pipe so that it can never hold FFmpeg up).
+    wav = readWav(filename)
+    if wav is not None and wav['SampleRate'] == SAMPLERATE and wav['Channels'] == CHANNELS:
+        return({'Name': filename, 'Samples': wav['Samples'], 'Frames': wav['Frames']})
+    metadata = clipMetadata([filename])[filename]
+    errors = tempfile.TemporaryFile(dir=temporaryLocation())
+    process = subprocess.Popen(ffmpegCommand("-v", "error", "-i", filename, "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "pipe:1"),
+                               stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errors)
+    return({'Name': filename, 'Samples': int(metadata['Duration'] * SAMPLERATE), 'Process': process, 'Errors': errors})
+
+def interweaveBlock(source, start, length, needed):
+    # The next 'length' samples of a source (see interweaveSource), beginning 'start'
+    # samples in, as float32 with full scale 1.0, or None if they aren't needed.
+    # A piped source is read whether they are needed or not, to keep its place.
+    if 'Process' in source:
+        data = source['Process'].stdout.read(length * CHANNELS * 4)
+        if not needed:
+            return(None)
+        block = numpy.zeros((length, CHANNELS), dtype=numpy.float32)
+        samples = numpy.frombuffer(data[:len(data) - len(data) % (CHANNELS * 4)], dtype="<f4").reshape(-1, CHANNELS)
+        block[:len(samples)] = samples
+        return(block)
+    if not needed:
+        return(None)
+    block = numpy.zeros((length, CHANNELS), dtype=numpy.float32)
+    frames = source['Frames'][start:start + length]
+    offset, scale = sampleScale(frames.dtype)
+    block[:len(frames)] = frames
+    block[:len(frames)] -= offset
+    block[:len(frames)] /= scale
+    return(block)
+
+def interweaveGains(lengths, sliceSamples, crossfade):
+    # The volume envelope of every file that interweaveFiles weaves together, as
+    # a list (one for each file) of lists of times and gains (in samples, and from
+    # 0 to 1), for numpy.interp. The files take turns, one slice each, in the order
+    # given. A file that has finished, or that would finish before it had faded in,
+    # loses its turn to the next that wouldn't, and one that finishes during its turn
+    # hands over to the next there and then; the weave ends when the longest file
+    # does. At each change of file, one fades out as the next fades in, over
+    # 'crossfade' samples centred on the change, or ending at it if the file fading
+    # out has finished. A fade never begins before the one before it has ended, nor
+    # ends after the file fading out does, so it may be shorter.
+    half = crossfade / 2
+    gains = [[[0.0], [0.0]] for length in lengths]
+    time = 0
+    previous = None
+    lastNode = 0.0
+    while time < max(lengths):
+        turn = time // sliceSamples
+        candidates = [(turn + i) % len(lengths) for i in range(len(lengths))]
+        owners = [candidate for candidate in candidates if lengths[candidate] > time + half]
+        # Near the end, when none would last long enough, the one that lasts longest
+        # (the one already playing, if it does) plays to the end
+        owner = owners[0] if owners else max(candidates, key=lambda candidate: (lengths[candidate], candidate == previous))
+        if previous is None:
+            gains[owner][1][0] = 1.0
+        elif owner != previous:
+            if lengths[previous] <= time:
+                fade = (max(time - crossfade, lastNode), time)
+            else:
+                fade = (max(time - half, lastNode), time + half)
+            fade = (fade[0], max(min(fade[1], lengths[previous]), fade[0]))
+            for i, level in ((previous, 1.0), (owner, 0.0)):
+                gains[i][0] += list(fade)
+                gains[i][1] += [level, 1.0 - level]
+            lastNode = fade[1]
+        previous = owner
+        time = min((turn + 1) * sliceSamples, lengths[owner])
+    return(gains)
+
+def interweaveFiles(fileList, outputFile, sliceDuration=20, crossfade=8):
+    # Interweaves any number of files: the output is each file in turn, for
+    # sliceDuration seconds at a time, each slice taken from the same moment of its
+    # file as the moment it fills in the output, and fading into the next over
+    # 'crossfade' seconds (a linear fade, as FFmpeg's acrossfade makes).
+    # Files of different lengths are allowed (see interweaveGains). Every file is
+    # read once, from start to finish, a block at a time, so the time taken grows
+    # only with the length of the result. The result is written to outputFile
+    # as a 16-bit WAV file at SAMPLERATE with CHANNELS channels.
+    # Returns the name of the file written.
+    if crossfade > sliceDuration:
+        raise ValueError("The crossfade (%s seconds) can't be longer than a slice (%s seconds)" % (crossfade, sliceDuration))
+    sources = [interweaveSource(fileName) for fileName in fileList]
+    try:
+        lengths = [source['Samples'] for source in sources]
+        totalSamples = max(lengths)
+        gains = interweaveGains(lengths, int(sliceDuration * SAMPLERATE), int(crossfade * SAMPLERATE))
+        def woven():
+            for start in range(0, totalSamples, MIXBLOCK):
+                length = min(MIXBLOCK, totalSamples - start)
+                times = numpy.arange(start, start + length, dtype=numpy.float64)
+                accumulator = numpy.zeros((length, CHANNELS), dtype=numpy.float32)
+                for source, (nodeTimes, nodeGains) in zip(sources, gains):
+                    gain = numpy.interp(times, nodeTimes, nodeGains).astype(numpy.float32)
+                    block = interweaveBlock(source, start, length, gain.any())
+                    if block is not None:
+                        accumulator += block * gain[:, None]
+                yield(accumulator.tobytes())
+        command = ffmpegCommand("-y", "-f", "f32le", "-ar", str(SAMPLERATE), "-ac", str(CHANNELS), "-i", "pipe:0",
+                                "-acodec", "pcm_s16le", outputFile)
+        runFFmpeg(command, woven()).check_returncode()
+        for source in sources:
+            if 'Process' in source:
+                # Anything left over (its duration may have been rounded down) is
+                # thrown away, so that FFmpeg can finish, and say whether it decoded
+                # the whole file
+                while source['Process'].stdout.read(1 << 20):
+                    pass
+                if source['Process'].wait() != 0:
+                    source['Errors'].seek(0)
+                    raise subprocess.CalledProcessError(source['Process'].returncode, source['Process'].args,
+                                                        stderr=source['Errors'].read().decode("utf-8", "replace"))
+    finally:
+        for source in sources:
+            if 'Process' in source:
+                source['Process'].stdout.close()
+                source['Process'].wait()
+                source['Errors'].close()
+    return(outputFile)
+
+
+
+
+# Worker processes (used for mixing) import this file again, so everything below
+# must only run when the file is run as a program.
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Make soundscapes from collections of sounds")
+    parser.add_argument("--worker", metavar="QUEUEFILE", help="do jobs from this queue (see runWorker) instead of the commands below")
+    parser.add_argument("--threads", type=int, default=1, help="how many jobs a worker does at once")
+    parser.add_argument("--idle", type=float, help="stop working after this many seconds without a job")
+    parser.add_argument("--profile", metavar="TRACEFILE", help="record where the time goes (see startProfile), and save it here")
+    arguments = parser.parse_args()
+    if arguments.profile:
+        startProfile(arguments.profile)
+        atexit.register(stopProfile)
+    if arguments.worker:
+        runWorker(arguments.worker, arguments.threads, arguments.idle)
+        sys.exit()
+
+    # TESTING OR YOUR MAIN COMMANDS BEGIN HERE
+
+    # This command creates mono files out of all files in the directory given
+    # at a standard volume level.
+    #standardiseDirectory("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/")
+
+    # This command creates repitched versions of all files in a particular directory
+    # creating eight (default, can be changed in the call) variants
+    #pitchShiftDirectory("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED", variants=16)
+
+    # This returns a list of lists, consisting of multi-channel volume control points
+    # for each file discovered. These lists can be used to control FFmpeg in the next step
+    #renderList = makeVolumeAndTimeNodeList("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED")
+
+    # Or, for a ring of speakers (see SPEAKERLAYOUTS; set CHANNELS to match before mixing),
+    # this moves each sound around the speakers instead
+    #renderList = makeSpatialNodeList("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED", speakers=8)
+
+    # This command takes the list of lists consisting of multi-channel volume control points,
+    # and then executes FFmpeg with those parameters to create multi-channel files of each sound,
+    # ready for playback on multi-channel systems, or for further mixing.
+    #result = repitchRenderList(renderList)
+
+    # This example command remixes random selections from sets of files in the given directory,
+    # between a low and high number. The example you see mixes betweeen 161 and 559 files into
+    # multi-channel files for playback.
+    #for mixNumber in range(36, 80):
+    #    result = mixDirectoryFiles("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED", count=mixNumber)
+    #pprint.pprint(result)
+
+    # This command interweaves two (or more) files, twenty seconds of each at a time.
+    #interweaveFiles(["E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/MIX-64-3600-H3YSXY6XN.wav",
+    #                 "E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/MIX-4-3600-CW6UGJWVW.wav"],
+    #                "E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/WOVEN.wav")
+
+
+    # This command, using parallel processes, converts uncompressed files ready for compressed distribtion
+    result = multipleConvert("E:/Users/john/Documents/REAPER Media/CROSSINGS/SOURCES/PROCESSED/VOLUMEPROCESSED/mixed/recursive/")
 
 
 
@@ -0,0 +1,205 @@
+# Benchmarks for Chorus
+#
+# Makes a synthetic collection of sine and noise clips with FFmpeg, then times each
+# stage of Chorus's processing on it at several scales, and saves the results
+# as JSON so that one version of Chorus can be compared with another:
+#
+#     python ChorusBenchmark.py --scales 10 100 1000 --output before.json
+#     python ChorusBenchmark.py --scales 10 100 1000 --output after.json --compare before.json
+#
+# Each stage runs in a fresh process of its own, so that the peak memory and
+# the disk traffic reported belong to that stage alone.
+
+import argparse, concurrent.futures, datetime, json, logging, multiprocessing, os, platform, shutil, subprocess, sys, time
+
+import Chorus
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The order in which the stages run; each uses what the one before it made
+STAGES = ["standardise", "pitch", "render", "mix", "convert"]
+
+def makeCorpus(directory, count, length):
+    # Makes 'count' clips of 'length' seconds each, alternately sine tones of
+    # different pitches and bursts of pink noise, as FLAC files so that standardizing
+    # them involves some decoding
+    os.makedirs(directory, exist_ok=True)
+    jobs = list()
+    for i in range(count):
+        if i % 2 == 0:
+            source = "sine=frequency=%d:duration=%s" % (110 + (i * 37) % 1800, length)
+        else:
+            source = "anoisesrc=color=pink:amplitude=0.3:duration=%s:seed=%d" % (length, i)
+        jobs.append({'Name': "clip %d" % i, 'Stage': "corpus",
+                     'Command': Chorus.ffmpegCommand("-v", "error", "-y", "-f", "lavfi", "-i", source,
+                                                     "-ar", "44100", directory + "/clip%05d.flac" % i)})
+    results = Chorus.runJobs(jobs)
+    failed = [result for result in results if result['ReturnCode'] != 0]
+    if failed:
+        raise RuntimeError("Could not make the synthetic clips: %s" % failed[0]['Stderr'])
+    return()
+
+def audioSeconds(directory):
+    # The total duration of the audio files in a directory
+    fileList = [directory + "/" + fileName for fileName in Chorus.filterAudioFiles(os.listdir(directory))]
+    return(sum(metadata['Duration'] for metadata in Chorus.clipMetadata(fileList).values()))
+
+def diskBytes():
+    # Bytes this process has really read from and written to storage (not the page
+    # cache), and the same for the child processes it has waited for
+    read = written = 0
+    try:
+        with open("/proc/self/io") as handle:
+            counters = dict(line.split(": ") for line in handle.read().splitlines())
+        read += int(counters['read_bytes'])
+        written += int(counters['write_bytes'])
+    except (OSError, KeyError):
+        pass
+    if resource is not None:
+        # Block counts are in units of 512 bytes
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read += children.ru_inblock * 512
+        written += children.ru_oublock * 512
+    return(read, written)
+
+def peakMemory():
+    # The largest resident set size of this process, and of any of its children, in bytes
+    if resource is None:
+        return(None, None)
+    # Linux reports kilobytes, macOS bytes
+    unit = 1 if sys.platform == "darwin" else 1024
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+def runStage(settings, stage, workDirectory, scale):
+    # Runs in a fresh process: applies the settings to Chorus, runs one stage,
+    # and returns what was measured
+    for name, value in settings['Chorus'].items():
+        setattr(Chorus, name, value)
+    logging.getLogger().setLevel(logging.WARNING)
+    corpus = workDirectory + "/corpus"
+    processed = corpus + "/PROCESSED"
+    volumeProcessed = processed + "/VOLUMEPROCESSED"
+    mixed = workDirectory + "/mixed"
+
+    # How much audio goes in, how many files, and what does the stage?
+    if stage == "standardise":
+        files = len(Chorus.filterAudioFiles(os.listdir(corpus)))
+        seconds = audioSeconds(corpus)
+        work = lambda: Chorus.standardiseDirectory(corpus, incremental=False)
+    elif stage == "pitch":
+        files = len(Chorus.filterAudioFiles(os.listdir(processed))) * settings['Variants']
+        seconds = audioSeconds(processed) * settings['Variants']
+        work = lambda: Chorus.pitchShiftDirectory(processed, variants=settings['Variants'], incremental=False)
+    elif stage == "render":
+        files = len(Chorus.filterAudioFiles(os.listdir(processed)))
+        seconds = audioSeconds(processed)
+        work = lambda: Chorus.repitchRenderList(Chorus.makeVolumeAndTimeNodeList(processed), engine=settings['Engine'], incremental=False)
+    elif stage == "mix":
+        files = len(Chorus.filterAudioFiles(os.listdir(volumeProcessed)))
+        seconds = settings['MixDuration']
+        def work():
+            outputFile = Chorus.mixDirectoryFiles(volumeProcessed, count=files, renderDuration=settings['MixDuration'],
+                                                  engine=settings['Engine'], workers=settings['Workers'])
+            # Keep the mix away from the files that will be mixed at the next scale
+            os.makedirs(mixed, exist_ok=True)
+            shutil.move(outputFile, mixed + "/" + os.path.basename(outputFile))
+            return([])
+    elif stage == "convert":
+        files = len(Chorus.filterAudioFiles(os.listdir(mixed)))
+        seconds = audioSeconds(mixed)
+        work = lambda: Chorus.multipleConvert(mixed, incremental=False)
+
+    readBefore, writtenBefore = diskBytes()
+    startTime = time.monotonic()
+    results = work()
+    wall = time.monotonic() - startTime
+    readAfter, writtenAfter = diskBytes()
+    peak, childPeak = peakMemory()
+    return({'Scale': scale, 'Stage': stage, 'Files': files, 'AudioSeconds': seconds, 'Wall': wall,
+            'RealtimeFactor': seconds / wall if wall else None, 'FilesPerSecond': files / wall if wall else None,
+            'PeakRSS': peak, 'ChildPeakRSS': childPeak,
+            'BytesRead': readAfter - readBefore, 'BytesWritten': writtenAfter - writtenBefore,
+            'Failures': len([result for result in results if result['ReturnCode'] != 0])})
+
+def chorusVersion():
+    # The git commit of Chorus being measured, if there is one
+    try:
+        return(subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(Chorus.__file__)),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+def benchmark(workDirectory, scales=(10, 100, 1000, 10000), clipLength=10, variants=2, mixDuration=60,
+              engine="ffmpeg", workers=1, stages=STAGES, settings=None):
+    # Runs every stage at every scale, and returns a dictionary describing the
+    # machine, the version of Chorus, and the results of every stage
+    benchmarkSettings = {'Chorus': settings or dict(), 'Variants': variants, 'MixDuration': mixDuration,
+                         'Engine': engine, 'Workers': workers}
+    results = list()
+    # A fresh process for each stage, never one forked from this (which already has memory to show for itself)
+    context = multiprocessing.get_context("spawn")
+    for scale in scales:
+        scaleDirectory = os.path.abspath(workDirectory) + "/%d" % scale
+        shutil.rmtree(scaleDirectory, ignore_errors=True)
+        logging.info("Making %d clips of %s seconds" % (scale, clipLength))
+        makeCorpus(scaleDirectory + "/corpus", scale, clipLength)
+        for stage in stages:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(runStage, benchmarkSettings, stage, scaleDirectory, scale).result()
+            logging.info("%d files, %s: %.2f seconds, %.1fx real time" % (scale, stage, result['Wall'], result['RealtimeFactor'] or 0))
+            results.append(result)
+        shutil.rmtree(scaleDirectory, ignore_errors=True)
+    return({'Date': datetime.datetime.now().isoformat(), 'Version': chorusVersion(), 'Python': platform.python_version(),
+            'Machine': platform.platform(), 'Cores': os.cpu_count(), 'ClipLength': clipLength, 'Settings': benchmarkSettings,
+            'Results': results})
+
+def printResults(report, previous=None):
+    # Prints a table of results, and how each compares with a previous report if one is given
+    before = dict()
+    if previous is not None:
+        before = {(result['Scale'], result['Stage']): result for result in previous['Results']}
+    print("%7s %-12s %10s %10s %10s %9s %9s %9s %s" % ("Files", "Stage", "Seconds", "Realtime", "Files/s", "RSS MB", "Read MB", "Write MB", "Change"))
+    for result in report['Results']:
+        change = ""
+        earlier = before.get((result['Scale'], result['Stage']))
+        if earlier is not None and result['Wall']:
+            change = "%.2fx faster" % (earlier['Wall'] / result['Wall'])
+        peak = max(result['PeakRSS'] or 0, result['ChildPeakRSS'] or 0)
+        print("%7d %-12s %10.2f %10.1f %10.1f %9.1f %9.1f %9.1f %s" % (result['Scale'], result['Stage'], result['Wall'],
+              result['RealtimeFactor'] or 0, result['FilesPerSecond'] or 0, peak / 1e6, result['BytesRead'] / 1e6,
+              result['BytesWritten'] / 1e6, change))
+    return()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each stage of Chorus on a synthetic collection of sounds")
+    parser.add_argument("--workdir", default="chorus-benchmark", help="where to make the synthetic files (deleted afterwards)")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 100, 1000, 10000], help="numbers of clips to try")
+    parser.add_argument("--length", type=float, default=10, help="length of each clip in seconds")
+    parser.add_argument("--variants", type=int, default=2, help="pitch variants of each clip")
+    parser.add_argument("--mix-duration", type=float, default=60, help="length of the mix in seconds")
+    parser.add_argument("--engine", choices=["ffmpeg", "numpy"], default="ffmpeg", help="engine for rendering and mixing")
+    parser.add_argument("--workers", type=int, default=1, help="processes sharing the mix")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to time")
+    parser.add_argument("--ffmpeg", help="directory containing FFmpeg, if not Chorus's FFMPEG setting")
+    parser.add_argument("--output", default="chorus-benchmark-%s.json" % datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),
+                        help="JSON file for the results")
+    parser.add_argument("--compare", help="JSON results of an earlier benchmark to compare with")
+    arguments = parser.parse_args()
+
+    settings = dict()
+    if arguments.ffmpeg:
+        settings['FFMPEG'] = arguments.ffmpeg.rstrip("/") + "/"
+        Chorus.FFMPEG = settings['FFMPEG']
+    report = benchmark(arguments.workdir, arguments.scales, arguments.length, arguments.variants, arguments.mix_duration,
+                       arguments.engine, arguments.workers, arguments.stages, settings)
+    with open(arguments.output, "w") as handle:
+        json.dump(report, handle, indent=1)
+    previous = None
+    if arguments.compare:
+        with open(arguments.compare) as handle:
+            previous = json.load(handle)
+    printResults(report, previous)